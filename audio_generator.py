@@ -1,8 +1,21 @@
 import torch
 from TTS.api import TTS
 import gradio as gr
+import gc
+import hashlib
 import os 
+import re
 import shutil
+import threading
+import time
+import uuid
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from file_store import FileStore
+from instrumentation import debug, error, info, metrics
+from utils import clean_sentences
 
 
 # Setup 
@@ -11,54 +24,375 @@ device = 'cuda' if torch.cuda.is_available() else 'cpu'
 # Directory with speaker audio files
 speaker_directory = "./input_audio/"
 output_directory = "./output_audio/"
+# Voices recorded by a user live in their own subdirectory, shared voices stay at the top of speaker_directory
+user_speaker_directory = os.path.join(speaker_directory, "users")
+
+# Generated narration, stored by content (text + speaker + model) and bounded in size and age
+AUDIO_STORE_DIR = os.getenv("AUDIO_STORE_DIR", os.path.join(output_directory, "store"))
+AUDIO_STORE_MAX_MB = float(os.getenv("AUDIO_STORE_MAX_MB", "2048"))
+AUDIO_STORE_MAX_AGE = float(os.getenv("AUDIO_STORE_MAX_AGE", str(7 * 24 * 3600)))  # seconds since last use, 0 means no expiry
+
+# Streaming narration merges sentences shorter than this many characters into the next one
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "40"))
+
+# TTS model by name (see TTS().list_models()), empty means the first listed model
+TTS_MODEL_NAME = os.getenv("TTS_MODEL_NAME", "")
+# How many models a process keeps loaded at once, and the free memory (MB) to keep before loading another one
+TTS_MAX_LOADED_MODELS = int(os.getenv("TTS_MAX_LOADED_MODELS", "1"))
+TTS_MIN_FREE_MEMORY_MB = int(os.getenv("TTS_MIN_FREE_MEMORY_MB", "2048"))
+
+
+def free_memory_mb(device: str) -> Optional[float]:
+    # Free memory on the device the models live on, None if it can't be determined
+    if device == 'cuda':
+        free_bytes, _ = torch.cuda.mem_get_info()
+        return free_bytes / 2 ** 20
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class TTSModelManager:
+    """Loads TTS models once per process and keeps them warm on the configured device.
+
+    Models are kept in least-recently-used order. Before another model is loaded, the least recently used ones are
+    evicted to stay within max_models and to keep min_free_memory_mb available.
+    """
+
+    def __init__(self, device: str, max_models: int = TTS_MAX_LOADED_MODELS,
+                 min_free_memory_mb: int = TTS_MIN_FREE_MEMORY_MB):
+        self.device = device
+        self.max_models = max_models
+        self.min_free_memory_mb = min_free_memory_mb
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._synthesis_locks = {}  # model name -> lock held while the model synthesizes
+        self._default_model_name = None
+
+    def default_model_name(self) -> str:
+        if TTS_MODEL_NAME:
+            return TTS_MODEL_NAME
+        if self._default_model_name is None:
+            # Listing models reads the model registry, so it is done once
+            model_manager = TTS().list_models()
+            self._default_model_name = model_manager.list_tts_models()[0]
+        return self._default_model_name
+
+    def get(self, model_name: Optional[str] = None) -> TTS:
+        model_name = model_name or self.default_model_name()
+        with self._lock:
+            if model_name in self._models:
+                self._models.move_to_end(model_name)
+                return self._models[model_name]
+
+            self._make_room()
+            info(f"Loading TTS model {model_name} on {self.device}")
+            with metrics.span("tts_load", device=self.device):
+                tts = TTS(model_name).to(self.device)
+            self._models[model_name] = tts
+            return tts
+
+    def synthesis_lock(self, model_name: str) -> threading.RLock:
+        # XTTS keeps per-call conditioning state on the model, so one loaded model synthesizes for one caller at a
+        # time (narration workers, Gradio handlers and the latent precompute thread all share it)
+        with self._lock:
+            return self._synthesis_locks.setdefault(model_name, threading.RLock())
+
+    def warmup(self, model_name: Optional[str] = None) -> None:
+        self.get(model_name)
+
+    def loaded_models(self):
+        return list(self._models)
+
+    def _make_room(self) -> None:
+        while self._models and (len(self._models) >= self.max_models or self._low_on_memory()):
+            self._evict(next(iter(self._models)))
+
+    def _low_on_memory(self) -> bool:
+        free = free_memory_mb(self.device)
+        return free is not None and free < self.min_free_memory_mb
+
+    def evict(self, model_name: str) -> None:
+        with self._lock:
+            self._evict(model_name)
+
+    def _evict(self, model_name: str) -> None:
+        if self._models.pop(model_name, None) is None:
+            return
+        info(f"Unloading TTS model {model_name}")
+        gc.collect()
+        if self.device == 'cuda':
+            torch.cuda.empty_cache()
+
+
+# One manager per process (per Gradio worker)
+model_manager = TTSModelManager(device)
+
+# Conditioning latents of cloned voices, computed once per speaker file and model
+speaker_latent_directory = os.getenv("SPEAKER_LATENT_DIR", "./.cache/speaker_latents/")
+
+
+# Silence Synthesizer.tts appends after every sentence, kept so cached-latent narration has the same pacing
+SENTENCE_PAUSE_SAMPLES = 10000
+
+
+def conditioning_settings(tts: TTS) -> dict:
+    # The speaker settings Xtts.synthesize takes from the model config, so the cloned voice matches tts_to_file
+    config = tts.synthesizer.tts_model.config
+    return {"gpt_cond_len": config.gpt_cond_len, "gpt_cond_chunk_len": config.gpt_cond_chunk_len,
+            "max_ref_length": config.max_ref_len, "sound_norm_refs": config.sound_norm_refs}
+
+
+def inference_settings(tts: TTS) -> dict:
+    # The sampling settings Xtts.synthesize takes from the model config
+    config = tts.synthesizer.tts_model.config
+    return {"temperature": config.temperature, "length_penalty": config.length_penalty,
+            "repetition_penalty": config.repetition_penalty, "top_k": config.top_k, "top_p": config.top_p}
+
+
+class SpeakerLatentCache:
+    """XTTS conditioning latents and speaker embeddings per (model, speaker wav) pair.
+
+    Computing them from the raw wav is a fixed cost on every synthesis call, so they are kept in memory and in
+    speaker_latent_directory. The key includes the file's path, size and mtime and the conditioning settings, so
+    re-recording a voice or changing the model config picks up new latents.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._latents = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(tts: TTS) -> bool:
+        # Only XTTS style models expose conditioning latents, others go through tts_to_file as before
+        tts_model = getattr(getattr(tts, "synthesizer", None), "tts_model", None)
+        return hasattr(tts_model, "get_conditioning_latents") and hasattr(tts_model, "inference")
+
+    def _key(self, model_name: str, speaker_wav: str, settings: dict) -> str:
+        stat = os.stat(speaker_wav)
+        identity = (f"{model_name}|{os.path.abspath(speaker_wav)}|{stat.st_size}|{stat.st_mtime_ns}|"
+                    f"{sorted(settings.items())}")
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def get(self, tts: TTS, model_name: str, speaker_wav: str):
+        # (gpt_cond_latent, speaker_embedding) for the speaker, computed and stored on the first call
+        settings = conditioning_settings(tts)
+        key = self._key(model_name, speaker_wav, settings)
+        with self._lock:
+            if key in self._latents:
+                return self._latents[key]
 
+        path = os.path.join(self.directory, f"{key}.pt")
+        if os.path.exists(path):
+            model_device = next(tts.synthesizer.tts_model.parameters()).device
+            stored = torch.load(path, map_location=model_device)
+            latents = (stored["gpt_cond_latent"], stored["speaker_embedding"])
+        else:
+            with torch.no_grad():
+                latents = tts.synthesizer.tts_model.get_conditioning_latents(audio_path=[speaker_wav], **settings)
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save({"gpt_cond_latent": latents[0], "speaker_embedding": latents[1]}, tmp_path)
+            os.replace(tmp_path, path)
 
+        with self._lock:
+            self._latents[key] = latents
+        return latents
 
-def get_speaker_names():
-    # get the names for the dropdown menu
+
+speaker_latents = SpeakerLatentCache(speaker_latent_directory)
+
+
+class AudioStore(FileStore):
+    """Content-addressed store for generated audio: one wav per (text, speaker file, model), in a FileStore bounded by
+    max_mb and max_age.
+
+    Asking for audio that was already generated returns the existing file.
+    """
+
+    def __init__(self, directory: str, max_mb: float = AUDIO_STORE_MAX_MB, max_age: float = AUDIO_STORE_MAX_AGE,
+                 evict_every: int = 20):
+        super().__init__(directory, ".wav", max_mb, max_age, evict_every)
+        # Requests for the same key wait for the first one instead of synthesizing it twice
+        self._key_locks = [threading.Lock() for _ in range(64)]
+
+    @staticmethod
+    def key(text: str, speaker_wav: str, model_name: str) -> str:
+        # The speaker file's size and mtime are part of the key, so re-recording a voice doesn't reuse old audio
+        stat = os.stat(speaker_wav)
+        identity = "|".join([model_name, os.path.abspath(speaker_wav), str(stat.st_size), str(stat.st_mtime_ns),
+                             " ".join(text.split())])
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def get_or_create(self, key: str, synthesize: Callable[[str], None]) -> str:
+        # synthesize(path) writes the wav to path, it is only called when the store has no file for key yet
+        path = self.path(key)
+        with self._key_locks[int(key[:8], 16) % len(self._key_locks)]:
+            if self.touch(path):
+                metrics.count("tts_store_hits_total")
+                return path
+            metrics.count("tts_store_misses_total")
+            return self.write(key, synthesize)
+
+
+audio_store = AudioStore(AUDIO_STORE_DIR)
+
+
+def user_directory(user_id: str) -> str:
+    # User ids come from a free text box, so the directory name is derived from them rather than being them
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", user_id)[:32]
+    return os.path.join(user_speaker_directory, f"{safe_id}_{hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:12]}")
+
+
+def speaker_path(speaker: str, user_id: Optional[str] = None) -> str:
+    # A user's own voice takes precedence over a shared voice with the same name
+    if user_id:
+        user_wav = os.path.join(user_directory(user_id), f"{speaker}.wav")
+        if os.path.exists(user_wav):
+            return user_wav
+    speaker_wav = os.path.join(speaker_directory, f"{speaker}.wav")
+    if not os.path.exists(speaker_wav):
+        raise FileNotFoundError(f"Speaker audio file {speaker_wav} does not exist.")
+    return speaker_wav
+
+
+def precompute_speaker_latents(speaker_wav: str, model_name: Optional[str] = None) -> None:
+    model_name = model_name or model_manager.default_model_name()
+    tts = model_manager.get(model_name)
+    if SpeakerLatentCache.supports(tts):
+        with model_manager.synthesis_lock(model_name):
+            speaker_latents.get(tts, model_name, speaker_wav)
+
+
+def synthesize_wav(tts: TTS, model_name: str, text: str, speaker_wav: str) -> List[float]:
+    # Uses cached speaker latents when the model supports them, otherwise tts() recomputes them from the wav
+    if not SpeakerLatentCache.supports(tts):
+        return tts.tts(text=text, speaker_wav=speaker_wav, language='en')
+
+    gpt_cond_latent, speaker_embedding = speaker_latents.get(tts, model_name, speaker_wav)
+    settings = inference_settings(tts)
+    wav = []
+    # XTTS has a per-call length limit, so synthesize sentence by sentence like tts_to_file does
+    for sentence in tts.synthesizer.split_into_sentences(text):
+        with torch.no_grad():
+            output = tts.synthesizer.tts_model.inference(sentence, 'en', gpt_cond_latent, speaker_embedding,
+                                                         **settings)
+        chunk = output["wav"]
+        wav.extend(chunk.tolist() if hasattr(chunk, "tolist") else list(chunk))
+        wav.extend([0] * SENTENCE_PAUSE_SAMPLES)
+    return wav
+
+
+def synthesize_to_file(tts: TTS, model_name: str, text: str, speaker_wav: str, file_path: str) -> str:
+    if not SpeakerLatentCache.supports(tts):
+        tts.tts_to_file(text=text, speaker_wav=speaker_wav, language='en', file_path=file_path)
+        return file_path
+
+    tts.synthesizer.save_wav(wav=synthesize_wav(tts, model_name, text, speaker_wav), path=file_path)
+    return file_path
+
+
+def narration_chunks(text: str, min_chars: int = STREAM_MIN_CHARS) -> List[str]:
+    # Sentences from utils.clean_sentences, with very short ones merged into the next so each chunk is worth a call
+    chunks = []
+    current = ""
+    for sentence in clean_sentences(text):
+        current = f"{current} {sentence}".strip()
+        if len(current) >= min_chars:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def to_pcm16(wav: List[float]) -> np.ndarray:
+    return (np.clip(np.asarray(wav, dtype=np.float32), -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def get_speaker_names(user_id=None):
+    # get the names for the dropdown menu, the user's own voices first
 
     speaker_files = os.listdir(speaker_directory)
     # assuming files are named like "Name_voice_sample.wav" // os.path.splitext(file)[0]
     speaker_names = [os.path.splitext(file)[0] for file in speaker_files if file.endswith('.wav')]
+    if user_id and os.path.isdir(user_directory(user_id)):
+        user_names = sorted(os.path.splitext(file)[0] for file in os.listdir(user_directory(user_id))
+                            if file.endswith('.wav'))
+        speaker_names = user_names + [name for name in speaker_names if name not in user_names]
     return speaker_names
 
-def save_recording(audio_file_path):
-    # function saves user recordings to the speaker directory
+def save_recording(audio_file_path, user_id=None):
+    # function saves user recordings to the user's speaker directory, or the shared one without a user id
 
     if audio_file_path is None:
         return "No audio file recorded."
 
-    new_file_path = os.path.join(speaker_directory, 'user_voice.wav')
+    directory = user_directory(user_id) if user_id else speaker_directory
+    os.makedirs(directory, exist_ok=True)
+    new_file_path = os.path.join(directory, 'user_voice.wav')
 
-    shutil.move(audio_file_path,new_file_path)
+    # move next to the destination first, then rename, so a narration reading the old voice never sees a partial file
+    tmp_path = os.path.join(directory, f".user_voice.{uuid.uuid4().hex}.tmp")
+    shutil.move(audio_file_path, tmp_path)
+    os.replace(tmp_path, new_file_path)
+
+    # compute the cloned voice's latents in the background so the first narration with it doesn't pay for them
+    threading.Thread(target=_precompute_quietly, args=(new_file_path,), daemon=True).start()
     
-    return f"saved new voice as 'user_voice_wav'."
+    return gr.update(choices=get_speaker_names(user_id), value='user_voice')
+
+def _precompute_quietly(speaker_wav: str) -> None:
+    try:
+        precompute_speaker_latents(speaker_wav)
+    except Exception as e:
+        metrics.count("speaker_latent_errors_total")
+        error(f"Could not precompute speaker latents for {speaker_wav}: {e}")
 
-def generate_audio(text,speaker):
+def generate_audio(text, speaker, user_id=None, model_name=None, output_path=None):
     # TTS function
 
-    model_manager = TTS().list_models()
-    tts_models = model_manager.list_tts_models()
-    
-    # load in model
-    tts = TTS(tts_models[0]).to('cpu')
+    # File setup, raises if the speaker file doesn't exist
+    speaker_wav = speaker_path(speaker, user_id)
+    model_name = model_name or model_manager.default_model_name()
 
-    # File setup
-    speaker_wav = os.path.join(speaker_directory, f"{speaker}.wav")
+    def synthesize(path):
+        # warm model from the manager, loaded on the first call only
+        tts = model_manager.get(model_name)
+        # generate audio using the selected speaker
+        with model_manager.synthesis_lock(model_name), metrics.span("tts_synthesis", mode="file"):
+            synthesize_to_file(tts, model_name, text, speaker_wav, path)
+        metrics.count("tts_audio_bytes_total", os.path.getsize(path), mode="file")
 
+    if output_path:
+        synthesize(output_path)
+        return output_path
 
-    # check if the speaker file exists before trying to process it
-    if not os.path.exists(speaker_wav):
-        raise FileNotFoundError(f"Speaker audio file {speaker_wav} does not exist.")
+    # unique per content, so concurrent requests don't overwrite each other and repeated text isn't synthesized again
+    return audio_store.get_or_create(AudioStore.key(text, speaker_wav, model_name), synthesize)
 
-    audio_output = 'output_audio/gen_audio_1.wav'
+def stream_audio(text, speaker, user_id=None, model_name=None):
+    # Streaming TTS: synthesizes one sentence (chunk) at a time and yields (sample_rate, samples) as soon as each is
+    # ready, so a streaming gr.Audio starts playing after the first sentence instead of after the whole segment.
+    model_name = model_name or model_manager.default_model_name()
+    tts = model_manager.get(model_name)
 
-    # generate audio using the selected speaker
-    tts.tts_to_file(text=text, speaker_wav=speaker_wav, language='en', file_path=audio_output)
+    speaker_wav = speaker_path(speaker, user_id)
 
-    return audio_output
+    sample_rate = tts.synthesizer.output_sample_rate
+    for chunk in narration_chunks(text):
+        with model_manager.synthesis_lock(model_name), metrics.span("tts_synthesis", mode="stream"):
+            samples = to_pcm16(synthesize_wav(tts, model_name, chunk, speaker_wav))
+        metrics.count("tts_audio_bytes_total", samples.nbytes, mode="stream")
+        yield sample_rate, samples
 
-def refresh_speaker_list():
+def refresh_speaker_list(user_id=None):
     # refresh dropdown menu 
-    return gr.Dropdown.update(choices=get_speaker_names())
+    return gr.update(choices=get_speaker_names(user_id))
 
@@ -0,0 +1,268 @@
+# Component benchmarks for the story hot paths, run offline against local stand-ins.
+#
+#   python benchmarks/component_benchmark.py                    # report only
+#   python benchmarks/component_benchmark.py --save-baseline    # record the current numbers as the baseline
+#   python benchmarks/component_benchmark.py --check            # exit 1 when a path regressed against the baseline
+#
+# OpenAI is replaced by benchmarks/fake_backends.py on localhost and the vector index by the local store, so the
+# numbers are this repo's own overhead (plus any --llm-latency-ms injected). Every benchmark reports per-call
+# latency and the memory it allocates (tracemalloc peak and what is still held after the call); the story loop also
+# reports the prompt tokens sent on each turn. tiktoken and nltk load their data from their local caches, so run
+# them once with network access on a new machine.
+#
+# Latency baselines are only comparable on the machine that recorded them; prompt tokens are deterministic and are
+# compared exactly.
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baselines", "component_benchmark.json")
+
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_backends import FakeOpenAIServer  # noqa: E402
+
+IMAGE_DESCRIPTIONS = ["flying-purple-dragon", "enchanted-forest", "magical-unicorn", "eye-monster",
+                      "sleepy-castle", "singing-river"]
+USER_DATA = {"name": "Mia", "place": "the Whispering Woods", "tone": "gentle", "moral": "kindness",
+             "length": 6.0, "age": 5}
+SEGMENT = (
+    "Mia tiptoed along the mossy path while the fireflies blinked above her like tiny lanterns... "
+    "She heard a soft sniffle behind the old oak tree and stopped to listen. "
+    "A small fox with a bandaged paw looked up at her with big worried eyes!   "
+    "\"Are you lost?\" Mia asked kindly, kneeling down in the cool grass. "
+    "The fox nodded and explained that the path home had disappeared under the fallen leaves.. "
+) * 3
+
+
+def configure_environment(workdir: str, base_url: str) -> None:
+    # Must run before the repo modules are imported, they read their settings at import time
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-component-benchmark",
+        "OPENAI_BASE_URL": base_url,
+        "LLM_CACHE_BACKEND": "none",  # every call goes to the fake server, a cache hit would measure nothing
+        "VECTOR_STORE_BACKEND": "local",
+        "VECTOR_STORE_PATH": os.path.join(workdir, "vector_store"),
+        "STORY_CATALOG_PATH": os.path.join(workdir, "story_catalog.sqlite3"),
+        "IMAGE_REGISTRY_DIR": os.path.join(workdir, "generated_images"),
+        "METRICS_MODE": "prometheus",
+    })
+
+
+def measure(fn, repeats: int, inner: int = 1) -> dict:
+    # Latency per call over repeats timed runs of inner calls each, then one traced run for the allocations
+    fn()  # warm up: imports, tokenizer, connection pool
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(inner):
+            fn()
+        timings.append((time.perf_counter() - start) / inner)
+    tracemalloc.start()
+    fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": (statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]) * 1000,
+        "peak_alloc_kib": peak / 1024,
+        "retained_kib": retained / 1024,
+    }
+
+
+def stage_means(snapshot: dict) -> dict:
+    # Mean milliseconds per instrumented stage (llm_call, parse, embed, ...) seen during a benchmark
+    return {name: stats["mean"] * 1000 for name, stats in snapshot["histograms"].items()}
+
+
+def story_prompt_tokens(server: FakeOpenAIServer) -> list:
+    # Exact prompt tokens of each story segment request the server received, in order
+    from utils import count_tokens
+    return [sum(count_tokens(message["content"]) for message in request["messages"])
+            for request in server.requests if request["endpoint"] == "chat" and request["model"] == "gpt-4"]
+
+
+def bench_utils(repeats: int) -> dict:
+    from utils import clean_text, count_tokens, estimate_reading_time
+    return {
+        "utils.count_tokens": measure(lambda: count_tokens(SEGMENT), repeats, inner=100),
+        "utils.clean_text": measure(lambda: clean_text(SEGMENT), repeats, inner=100),
+        "utils.estimate_reading_time": measure(lambda: estimate_reading_time(SEGMENT), repeats, inner=1000),
+    }
+
+
+def bench_story_part(repeats: int) -> dict:
+    from story_generator import create_initial_prompt, create_system_prompt, extract_choices, generate_story_part
+
+    def one_part():
+        messages = [{"role": "system", "content": create_system_prompt(USER_DATA)},
+                    {"role": "user", "content": create_initial_prompt(USER_DATA, False)}]
+        part = generate_story_part(messages, USER_DATA["name"], list(IMAGE_DESCRIPTIONS))
+        assert len(part[4]) == 3, "fake segment should offer three choices"
+
+    content = generate_story_part([{"role": "system", "content": create_system_prompt(USER_DATA)},
+                                   {"role": "user", "content": create_initial_prompt(USER_DATA, False)}],
+                                  USER_DATA["name"], list(IMAGE_DESCRIPTIONS))[0]
+    return {
+        "story_generator.generate_story_part": measure(one_part, repeats),
+        "story_generator.extract_choices": measure(lambda: extract_choices(content), repeats, inner=1000),
+    }
+
+
+def run_story(stream: bool, token_budget: int) -> int:
+    # One whole story, always picking the first choice. Returns the number of segments.
+    from story_generator import generate_bedtime_story
+    story = generate_bedtime_story("benchmark-user", image_descriptions=list(IMAGE_DESCRIPTIONS), stream=stream,
+                                   context_options={"token_budget": token_budget}, **USER_DATA)
+    story_data = next(story)
+    while True:
+        while story_data.get("partial"):
+            story_data = next(story)
+        if story_data["complete"]:
+            return len(story_data["segments"])
+        story_data = story.send(story_data["choices"][0])
+
+
+def bench_story_loop(repeats: int, server: FakeOpenAIServer, token_budget: int) -> dict:
+    from instrumentation import metrics
+    results = {}
+    for stream in (False, True):
+        name = "story_generator.generate_bedtime_story" + (".stream" if stream else "")
+        metrics.reset()
+        result = measure(lambda: run_story(stream, token_budget), repeats)
+        server.reset()
+        result["segments"] = run_story(stream, token_budget)
+        tokens = story_prompt_tokens(server)
+        result["prompt_tokens_per_turn"] = tokens
+        result["prompt_token_growth_per_turn"] = (tokens[-1] - tokens[0]) / (len(tokens) - 1) if len(tokens) > 1 else 0
+        result["stages_ms"] = stage_means(metrics.snapshot())
+        results[name] = result
+    return results
+
+
+def bench_vector_db(repeats: int, stories: int) -> dict:
+    from vector_db_operation import (retrieve_existing_story_titles, summarize_and_upsert_stories,
+                                     summarize_and_upsert_story)
+
+    summarize_and_upsert_stories([
+        {"user_id": "benchmark-user", "name": f"Hero {i}", "story_name": f"story-{i}", "place": "the Whispering Woods",
+         "full_story": SEGMENT}
+        for i in range(stories)
+    ])
+    saved = iter(range(10 ** 9))
+    return {
+        "vector_db_operation.retrieve_existing_story_titles": measure(
+            lambda: retrieve_existing_story_titles("benchmark-user"), repeats),
+        "vector_db_operation.retrieve_existing_story_titles.page": measure(
+            lambda: retrieve_existing_story_titles("benchmark-user", limit=20), repeats),
+        "vector_db_operation.summarize_and_upsert_story": measure(
+            lambda: summarize_and_upsert_story("benchmark-user", "Mia", SEGMENT, "the Whispering Woods",
+                                               story_name=f"saved-{next(saved)}"), repeats),
+    }
+
+
+def bench_image_preprocess(repeats: int, workdir: str) -> dict:
+    # generate_images up to the pipeline call: loading, resizing and thresholding the sketches. Needs torch.
+    try:
+        from generating_image import load_sketches
+        from preprocess_benchmark import make_sketches
+    except Exception as e:
+        print(f"Skipping image preprocessing: {type(e).__name__}: {e}")
+        return {}
+    paths = make_sketches(workdir, 4, 800)
+    return {"generating_image.load_sketches": measure(lambda: load_sketches(paths, 1024), repeats)}
+
+
+def run(args, workdir: str) -> dict:
+    server = FakeOpenAIServer(latency=args.llm_latency_ms / 1000)
+    configure_environment(workdir, server.start())
+    try:
+        results = {}
+        results.update(bench_utils(args.repeats))
+        results.update(bench_story_part(args.repeats))
+        results.update(bench_story_loop(max(1, args.repeats // 4), server, args.token_budget))
+        results.update(bench_vector_db(args.repeats, args.stories))
+        results.update(bench_image_preprocess(max(1, args.repeats // 4), workdir))
+        return results
+    finally:
+        server.close()
+
+
+def print_report(results: dict) -> None:
+    print(f"\n{'benchmark':58s} {'median':>10s} {'p95':>10s} {'peak alloc':>12s} {'retained':>10s}")
+    for name, stats in results.items():
+        print(f"{name:58s} {stats['median_ms']:8.3f}ms {stats['p95_ms']:8.3f}ms {stats['peak_alloc_kib']:9.1f}KiB "
+              f"{stats['retained_kib']:7.1f}KiB")
+        if "prompt_tokens_per_turn" in stats:
+            print(f"{'':58s} prompt tokens per turn: {stats['prompt_tokens_per_turn']} "
+                  f"(+{stats['prompt_token_growth_per_turn']:.0f}/turn)")
+        for stage, mean_ms in sorted(stats.get("stages_ms", {}).items()):
+            print(f"{'':58s} {stage}: {mean_ms:.3f}ms mean")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # Regressions as readable lines. Latency and memory may grow by tolerance (plus a small absolute slack so
+    # sub-millisecond paths don't flap), prompt tokens may not grow at all.
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if stats["median_ms"] > base["median_ms"] * (1 + tolerance) + 0.05:
+            regressions.append(f"{name}: median {base['median_ms']:.3f}ms -> {stats['median_ms']:.3f}ms")
+        if stats["peak_alloc_kib"] > base["peak_alloc_kib"] * (1 + tolerance) + 16:
+            regressions.append(f"{name}: peak alloc {base['peak_alloc_kib']:.1f}KiB -> {stats['peak_alloc_kib']:.1f}KiB")
+        base_tokens = base.get("prompt_tokens_per_turn")
+        tokens = stats.get("prompt_tokens_per_turn")
+        if base_tokens and tokens and (len(tokens) != len(base_tokens) or
+                                       any(now > before for now, before in zip(tokens, base_tokens))):
+            regressions.append(f"{name}: prompt tokens per turn {base_tokens} -> {tokens}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency, allocations and prompt growth of the story hot paths")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--stories", type=int, default=200, help="saved stories in the catalog for the lookups")
+    parser.add_argument("--token-budget", type=int, default=3000, help="StoryContext prompt budget for the loop")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="delay injected by the fake OpenAI server")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--check", action="store_true", help="compare with --baseline and exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth for --check")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="component-benchmark-") as workdir:
+        results = run(args, workdir)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    if args.check:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
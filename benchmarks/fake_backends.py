@@ -0,0 +1,211 @@
+# Local stand-in for the OpenAI API, used by the benchmarks so they run offline and cost nothing.
+#
+#   python benchmarks/fake_backends.py --port 8089 --latency-ms 800      # serve it on its own
+#   OPENAI_BASE_URL=http://127.0.0.1:8089/v1 python gradio_app.py
+#
+# Serves /v1/chat/completions (blocking and streamed) and /v1/embeddings. Story requests get a segment in the format
+# the story engine parses, with three choices unless the prompt asks for the final part. Latency can be injected
+# before the response and between streamed tokens. The vector index needs no stand-in: VECTOR_STORE_BACKEND=local
+# is already an in-process store.
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+
+SENTENCES = [
+    "The moon rose slowly over the sleepy hills.",
+    "A soft wind carried the smell of warm bread from the village.",
+    "Somewhere in the tall grass a cricket began to sing.",
+    "The little lantern flickered, painting golden shapes on the path.",
+    "An owl blinked its round eyes and hooted a friendly hello.",
+    "Far away a river whispered stories to the smooth stones.",
+    "The stars leaned closer, curious about what would happen next.",
+    "A tiny fox peeked out from behind a mossy log.",
+]
+CHOICES = [
+    ["follow the glowing fireflies", "knock on the door of the old oak", "ask the owl for directions"],
+    ["cross the wobbly bridge", "share a snack with the fox", "climb the hill to see the stars"],
+    ["sing a song to the river", "look inside the hollow log", "wait for the moon to rise higher"],
+]
+FINAL_MARKER = "This is the final part of the story"
+
+
+def story_segment(messages: List[Dict[str, str]], number: int, words: int) -> str:
+    name_match = re.search(r"about ([^.\s]+(?: [^.\s]+)?) in ", messages[1]["content"]) if len(messages) > 1 else None
+    name = name_match.group(1) if name_match else "the hero"
+    sentences = []
+    while sum(len(sentence.split()) for sentence in sentences) < words:
+        sentences.append(SENTENCES[(number + len(sentences)) % len(SENTENCES)])
+    text = " ".join(sentences)
+    if any(FINAL_MARKER in message["content"] for message in messages):
+        return f"{text} And so {name} drifted off to sleep, happy and safe. The end."
+    choices = CHOICES[number % len(CHOICES)]
+    return f"{text}\n\nWhat will {name} do next?\n\n1. {choices[0]}\n2. {choices[1]}\n3. {choices[2]}"
+
+
+def fake_embedding(text: str, dimension: int) -> List[float]:
+    # Same text, same vector, so repeated runs query and upsert the same data
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32).round(6).tolist()
+
+
+def approximate_tokens(text: str) -> int:
+    # The usage block only needs to be plausible; benchmarks count exact prompt tokens from the request log
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIServer:
+    """OpenAI-compatible chat and embeddings endpoint on localhost, run from a background thread.
+
+    Every request is appended to requests as {"endpoint", "model", "messages" or "input", "stream"}.
+    """
+
+    def __init__(self, latency: float = 0.0, token_interval: float = 0.0, segment_words: int = 120,
+                 dimension: int = 1536, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.token_interval = token_interval
+        self.segment_words = segment_words
+        self.dimension = dimension
+        self.requests: List[Dict] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = []
+
+    def _record(self, request: Dict) -> int:
+        with self._lock:
+            self.requests.append(request)
+            return len(self.requests)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+            disable_nagle_algorithm = True  # headers and body are separate writes, Nagle would add ~40ms each
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.endswith("/chat/completions"):
+                    self._chat(body)
+                elif self.path.endswith("/embeddings"):
+                    self._embeddings(body)
+                else:
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def _chat(self, body: Dict):
+                stream = bool(body.get("stream"))
+                number = server._record({"endpoint": "chat", "model": body.get("model"),
+                                         "messages": body.get("messages", []), "stream": stream})
+                messages = body.get("messages", [])
+                if body.get("model", "").startswith("gpt-4"):
+                    content = story_segment(messages, number, server.segment_words)
+                else:
+                    content = "A short summary of the story so far, with the hero and the places they visited."
+                prompt_tokens = sum(approximate_tokens(message.get("content", "")) for message in messages)
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": approximate_tokens(content),
+                         "total_tokens": prompt_tokens + approximate_tokens(content)}
+                time.sleep(server.latency)
+                if not stream:
+                    self._send_json(200, {
+                        "id": f"chatcmpl-fake-{number}", "object": "chat.completion", "created": int(time.time()),
+                        "model": body.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                     "finish_reason": "stop"}],
+                        "usage": usage
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                chunk = {"id": f"chatcmpl-fake-{number}", "object": "chat.completion.chunk",
+                         "created": int(time.time()), "model": body.get("model")}
+                for token in re.findall(r"\S+\s*", content):
+                    if server.token_interval:
+                        time.sleep(server.token_interval)
+                    self._send_event({**chunk, "choices": [{"index": 0, "delta": {"content": token},
+                                                            "finish_reason": None}]})
+                self._send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                self._send_event({**chunk, "choices": [], "usage": usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def _embeddings(self, body: Dict):
+                inputs = body.get("input", [])
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                server._record({"endpoint": "embeddings", "model": body.get("model"), "input": inputs,
+                                "stream": False})
+                time.sleep(server.latency)
+                tokens = sum(approximate_tokens(text) for text in inputs)
+                self._send_json(200, {
+                    "object": "list", "model": body.get("model"),
+                    "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, server.dimension)}
+                             for i, text in enumerate(inputs)],
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+                })
+
+            def _send_json(self, status: int, payload: Dict):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_event(self, payload: Dict):
+                self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI chat/embeddings API on localhost")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before each response")
+    parser.add_argument("--token-interval-ms", type=float, default=0.0, help="delay between streamed tokens")
+    parser.add_argument("--segment-words", type=int, default=120)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=args.latency_ms / 1000, token_interval=args.token_interval_ms / 1000,
+                              segment_words=args.segment_words, port=args.port)
+    print(f"Fake OpenAI API on {server.base_url}")
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# Load generator for the story flow: N simulated families driving the real gradio_app handlers in one process.
+#
+#   python benchmarks/load_test.py --users 50
+#   python benchmarks/load_test.py --users 10,50,100,200 --llm-latency-ms 1500 --token-interval-ms 20
+#   python benchmarks/load_test.py --users 100 --think-time 5 --custom-ratio 0.3 --length 3 --narrate
+#
+# Each user starts a story with start_or_continue_story, picks a choice button (or types a custom choice) after a
+# think time until the story completes with handle_choice, then saves it with save_story. The handlers come from
+# create_interface (app.handlers), so sessions, speculation, narration queueing and the image gallery all run as in
+# production; only Gradio's HTTP and queue layer is left out.
+#
+# Backends are stand-ins with configurable latency: the fake OpenAI server from fake_backends.py in its own process
+# (so it doesn't compete for this process's GIL), the local vector store wrapped with --vector-latency-ms, and with
+# --narrate a TTS stub that sleeps --tts-latency-ms per segment. Passing several user counts runs one level after
+# the other, to find where p95 turn latency takes off. Peak RSS is the process high-water mark, so it only grows
+# from one level to the next.
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+
+sys.path.insert(0, REPO_ROOT)
+
+CUSTOM_CHOICES = ["give the fox a big hug", "sing a lullaby to the moon", "build a blanket fort",
+                  "ask the stars for a wish"]
+NARRATOR = "load-test-narrator"
+
+
+def configure_environment(workdir: str, base_url: str, session_backend: str) -> None:
+    # Must run before gradio_app is imported, the modules read their settings at import time
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_BASE_URL": base_url,
+        "LLM_CACHE_BACKEND": "none",
+        "VECTOR_STORE_BACKEND": "local",
+        "VECTOR_STORE_PATH": os.path.join(workdir, "vector_store"),
+        "STORY_CATALOG_PATH": os.path.join(workdir, "story_catalog.sqlite3"),
+        "STORY_SESSION_BACKEND": session_backend,
+        "STORY_SESSION_PATH": os.path.join(workdir, "story_sessions.sqlite3"),
+        "IMAGE_REGISTRY_DIR": os.path.join(workdir, "generated_images"),
+    })
+
+
+def start_fake_openai(args) -> tuple:
+    # Runs fake_backends.py in a subprocess and waits until it accepts connections
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "fake_backends.py"), "--port", str(port),
+                                "--latency-ms", str(args.llm_latency_ms),
+                                "--token-interval-ms", str(args.token_interval_ms)],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("Fake OpenAI server did not start")
+            time.sleep(0.1)
+
+
+class DelayedIndex:
+    """Vector index wrapper that sleeps before each call, standing in for Pinecone's round trip."""
+
+    def __init__(self, index, latency: float):
+        self.index = index
+        self.latency = latency
+
+    def upsert(self, vectors):
+        time.sleep(self.latency)
+        return self.index.upsert(vectors=vectors)
+
+    def query(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.index.query(*args, **kwargs)
+
+
+def install_stub_backends(args) -> None:
+    import audio_generator as ag
+    import vector_db_operation
+
+    if args.vector_latency_ms:
+        index = DelayedIndex(vector_db_operation.get_index(), args.vector_latency_ms / 1000)
+        vector_db_operation.get_index = lambda: index
+
+    def generate_audio(text, speaker, user_id=None, model_name=None, output_path=None):
+        # Runs on the narration workers like the real synthesis, so queueing and skipping behave the same
+        time.sleep(args.tts_latency_ms / 1000)
+        return output_path or os.path.join(ag.AUDIO_STORE_DIR, "load-test.wav")
+
+    ag.generate_audio = generate_audio
+
+
+class Stats:
+    """Latencies per turn kind, handler errors and completed stories for one load level."""
+
+    def __init__(self):
+        self.latencies = {}  # kind -> [seconds until the segment is shown]
+        self.first_text = []  # seconds until the first streamed text
+        self.errors = 0
+        self.stories = 0
+        self.tails = set()  # handler tails and narration playback still running after a turn was measured
+
+    def add(self, kind: str, seconds: float) -> None:
+        self.latencies.setdefault(kind, []).append(seconds)
+
+    def turns(self) -> list:
+        return [seconds for kind, values in self.latencies.items() if kind != "save" for seconds in values]
+
+
+async def drain(handler) -> None:
+    async for _ in handler:
+        pass
+
+
+def in_background(stats: Stats, coroutine) -> None:
+    # Runs beside the simulated user, the way the browser keeps receiving updates while the child reads and chooses
+    tail = asyncio.create_task(coroutine)
+    stats.tails.add(tail)
+    tail.add_done_callback(stats.tails.discard)
+
+
+async def drive(handler, stats: Stats, kind: str, components: dict):
+    # Reads one handler call up to the update carrying the session id, that is when the child sees the whole segment
+    # and the buttons, and returns that story state (display text, session id, choices, narration). Latency is taken
+    # there; whatever the handler yields after that is read by a background task, so think time starts right away.
+    state = {"text": None, "session_id": None, "narration": None, "choices": []}
+    start = time.perf_counter()
+    first = True
+    async for update in handler:
+        if first:
+            stats.first_text.append(time.perf_counter() - start)
+            first = False
+        if components["story_session_state"] in update:
+            stats.add(kind, time.perf_counter() - start)
+            state["session_id"] = update[components["story_session_state"]]
+            state["text"] = update.get(components["story_display"])
+            state["choices"] = [button_update.get("value") for button_update in
+                                (update.get(button, {}) for button in components["choice_buttons"])
+                                if isinstance(button_update, dict) and button_update.get("visible")]
+        if components["narration_state"] in update:
+            state["narration"] = update[components["narration_state"]]
+        if components["story_session_state"] in update:
+            in_background(stats, drain(handler))
+            break
+    if isinstance(state["text"], str) and state["text"].startswith("An error occurred"):
+        stats.errors += 1
+    return state
+
+
+async def simulate_user(number: int, app, args, stats: Stats, rng: random.Random) -> None:
+    handlers, components = app.handlers, app.story_components
+    user_id = f"load-user-{number}"
+    narrator = NARRATOR if args.narrate else None
+    await asyncio.sleep(rng.uniform(0, args.ramp_up))
+    for _ in range(args.stories):
+        name, place = f"Kid{number}", "the Whispering Woods"
+        state = await drive(handlers["start_or_continue_story"](user_id, narrator, True, name, place, "gentle",
+                                                                 "kindness", args.length, 5), stats, "start",
+                            components)
+        narration = state["narration"]
+        # Each turn's event is followed by a play_narration event, which waits for the audio while the child reads
+        in_background(stats, handlers["play_narration"](narration))
+        story = [state["text"] or ""]
+        while state["session_id"]:
+            await asyncio.sleep(args.think_time * rng.uniform(0.5, 1.5))
+            custom = rng.random() < args.custom_ratio or not state["choices"]
+            choice = rng.choice(CUSTOM_CHOICES) if custom else rng.choice(state["choices"])
+            state = await drive(handlers["handle_choice"](choice, state["session_id"], narration, user_id), stats,
+                                "custom" if custom else "choice", components)
+            in_background(stats, handlers["play_narration"](narration))
+            story.append(state["text"] or "")
+        stats.stories += 1
+
+        if rng.random() < args.save_ratio:
+            start = time.perf_counter()
+            message, _, _ = await handlers["save_story"](user_id, "\n\n".join(story), name, place)
+            stats.add("save", time.perf_counter() - start)
+            if message.startswith("Error"):
+                stats.errors += 1
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100)
+    return {"p50": statistics.median(values), "p95": cuts[94], "p99": cuts[98]}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def run_level(app, args, users: int) -> dict:
+    stats = Stats()
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate_user(i, app, args, stats, random.Random(rng.random())) for i in range(users)))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*stats.tails)  # so one level's narration doesn't spill into the next
+    turns = stats.turns()
+    return {
+        "users": users,
+        "seconds": elapsed,
+        "stories": stats.stories,
+        "turns": len(turns),
+        "errors": stats.errors,
+        "turns_per_second": len(turns) / elapsed,
+        "stories_per_second": stats.stories / elapsed,
+        "turn_latency": percentiles(turns),
+        "first_text_latency": percentiles(stats.first_text),
+        "latency_by_kind": {kind: percentiles(values) for kind, values in stats.latencies.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_level(result: dict) -> None:
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    turn = result["turn_latency"]
+    print(f"{result['users']:6d} users  {result['turns_per_second']:8.2f} turns/s  {result['stories_per_second']:6.2f} "
+          f"stories/s  turn p50 {ms(turn['p50'])} p95 {ms(turn['p95'])} p99 {ms(turn['p99'])}  "
+          f"errors {result['errors']}  peak RSS {result['peak_rss_mb']:.0f}MB")
+    for kind, stats in sorted(result["latency_by_kind"].items()):
+        print(f"{'':14s}{kind:8s} p50 {ms(stats['p50'])} p95 {ms(stats['p95'])} p99 {ms(stats['p99'])}")
+
+
+async def run(args, levels: list) -> list:
+    from gradio_app import create_interface
+    install_stub_backends(args)
+    app = create_interface()
+    # One story first, so imports, client pools and registering the shared images aren't billed to the first level
+    warmup = argparse.Namespace(**{**vars(args), "ramp_up": 0, "stories": 1, "think_time": 0})
+    warmup_stats = Stats()
+    await simulate_user(-1, app, warmup, warmup_stats, random.Random(args.seed))
+    await asyncio.gather(*warmup_stats.tails)
+    results = []
+    for users in levels:
+        result = await run_level(app, args, users)
+        print_level(result)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent simulated users driving the story handlers")
+    parser.add_argument("--users", default="10", help="simulated users, or a comma separated list of levels")
+    parser.add_argument("--stories", type=int, default=1, help="stories per user")
+    parser.add_argument("--length", type=float, default=3, help="story length in minutes, as on the slider")
+    parser.add_argument("--think-time", type=float, default=2.0, help="mean seconds a child takes to choose")
+    parser.add_argument("--custom-ratio", type=float, default=0.2, help="share of turns with a typed choice")
+    parser.add_argument("--save-ratio", type=float, default=1.0, help="share of finished stories that are saved")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="users start spread over this many seconds")
+    parser.add_argument("--narrate", action="store_true", help="narrate every segment with the TTS stub")
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+    parser.add_argument("--token-interval-ms", type=float, default=10.0, help="delay between streamed tokens")
+    parser.add_argument("--vector-latency-ms", type=float, default=50.0)
+    parser.add_argument("--tts-latency-ms", type=float, default=2000.0)
+    parser.add_argument("--session-backend", default="sqlite", choices=["sqlite", "memory"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    levels = [int(users) for users in args.users.split(",")]
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    server, base_url = start_fake_openai(args)
+    try:
+        with tempfile.TemporaryDirectory(prefix="load-test-") as workdir:
+            configure_environment(workdir, base_url, args.session_backend)
+            os.chdir(REPO_ROOT)  # the bundled ./images are registered as everyone's shared images
+            results = asyncio.run(run(args, levels))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Sketch preprocessing benchmark: per-image cost of turning uploaded doodles into adapter input.
+#
+#   python benchmarks/preprocess_benchmark.py
+#   python benchmarks/preprocess_benchmark.py --images 8 --size 800 --resolution 1024
+#
+# Compares the old per-image PIL path (invert, RGB, resize, threshold, back to PIL) with
+# generating_image.load_sketches, which resizes and thresholds all sketches as one tensor. No model is loaded.
+# Before timing, both paths run on the sample sketches in images/ and the generated ones, and the run fails if
+# their masks differ in more than --tolerance of the pixels (resampling differs slightly along stroke edges).
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+import torchvision.transforms.functional as TF
+from PIL import Image, ImageDraw, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generating_image import load_sketches, pad_image_to_multiple  # noqa: E402
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "images")
+
+
+def make_sketches(directory: str, count: int, size: int, seed: int = 0) -> list:
+    # Black strokes on white, like the drawing canvas produces
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        image = Image.new("RGB", (size, size), "white")
+        draw = ImageDraw.Draw(image)
+        for _ in range(30):
+            points = [(rng.randrange(size), rng.randrange(size)) for _ in range(4)]
+            draw.line(points, fill="black", width=rng.randint(2, 12))
+        path = os.path.join(directory, f"sketch_{i}.png")
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+def legacy_preprocess(paths: list, resolution: int) -> list:
+    # generate_images before load_sketches, one PIL/tensor round trip per image
+    sketches = []
+    for path in paths:
+        image = Image.open(path).convert("L")
+        image = ImageOps.invert(image)
+        image = image.convert("RGB")
+        image = image.resize((resolution, resolution), Image.BICUBIC)
+        image_tensor = TF.to_tensor(image) > 0.5
+        sketches.append(TF.to_pil_image(image_tensor.to(torch.float32)))
+    return sketches
+
+
+def sample_sketches() -> list:
+    if not os.path.isdir(SAMPLE_DIR):
+        return []
+    return sorted(os.path.join(SAMPLE_DIR, name) for name in os.listdir(SAMPLE_DIR) if name.endswith(".png"))
+
+
+def mask_mismatch(paths: list, resolution: int) -> list:
+    # Fraction of pixels where the two paths disagree, per sketch. The legacy masks were padded afterwards in
+    # generate_images, load_sketches pads them itself.
+    legacy = torch.stack([TF.to_tensor(pad_image_to_multiple(image)) for image in legacy_preprocess(paths, resolution)])
+    batched = load_sketches(paths, resolution)
+    assert legacy.shape == batched.shape, f"mask shapes differ: {tuple(legacy.shape)} vs {tuple(batched.shape)}"
+    return (legacy != batched).flatten(1).to(torch.float32).mean(dim=1).tolist()
+
+
+def check_equivalence(paths: list, resolution: int, tolerance: float) -> float:
+    mismatches = mask_mismatch(paths, resolution)
+    for path, mismatch in zip(paths, mismatches):
+        assert mismatch <= tolerance, (
+            f"{os.path.basename(path)}: masks differ in {mismatch:.2%} of pixels, more than {tolerance:.2%}")
+    return max(mismatches)
+
+
+def time_per_image(fn, paths: list, resolution: int, repeats: int) -> float:
+    fn(paths, resolution)  # warm up file cache and kernels
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(paths, resolution)
+        timings.append((time.perf_counter() - start) / len(paths))
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-image cost of sketch preprocessing")
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--size", type=int, default=800, help="side of the uploaded sketches in pixels")
+    parser.add_argument("--resolution", type=int, default=1024, help="side of the adapter input")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="largest fraction of pixels whose masks may differ between the two paths")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="preprocess-benchmark-") as directory:
+        paths = make_sketches(directory, args.images, args.size)
+        max_mismatch = check_equivalence(sample_sketches() + paths, args.resolution, args.tolerance)
+        results = {
+            "max_mask_mismatch": max_mismatch,
+            "legacy_ms_per_image": time_per_image(legacy_preprocess, paths, args.resolution, args.repeats) * 1000,
+            "batched_ms_per_image": time_per_image(load_sketches, paths, args.resolution, args.repeats) * 1000,
+        }
+
+    print(f"{args.images} sketches of {args.size}px -> {args.resolution}px, torch threads: {torch.get_num_threads()}")
+    print(f"  per-image PIL path   {results['legacy_ms_per_image']:8.1f} ms/image")
+    print(f"  batched tensor path  {results['batched_ms_per_image']:8.1f} ms/image")
+    print(f"  masks match within {args.tolerance:.2%} of pixels (worst sketch {max_mismatch:.2%})")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Cold-start benchmark: how long importing the story modules takes and whether the import touches the network.
+#
+#   python benchmarks/startup_benchmark.py
+#   python benchmarks/startup_benchmark.py --compare-ref <git ref>   # same probe against an older checkout
+#
+# Each run is a fresh interpreter. Socket connects and DNS lookups made during the import are counted, so a
+# module that talks to Pinecone/OpenAI at import time shows up even when the network is down (the import then
+# fails and is reported as such).
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["llm_client", "vector_db_operation", "story_generator"]
+
+PROBE = """
+import json, socket, sys, time
+calls = []
+_connect = socket.socket.connect
+_getaddrinfo = socket.getaddrinfo
+def connect(self, address):
+    calls.append("connect " + str(address))
+    return _connect(self, address)
+def getaddrinfo(host, *args, **kwargs):
+    calls.append("dns " + str(host))
+    return _getaddrinfo(host, *args, **kwargs)
+socket.socket.connect = connect
+socket.getaddrinfo = getaddrinfo
+start = time.perf_counter()
+error = None
+try:
+    import {module}
+except Exception as e:
+    error = type(e).__name__ + ": " + str(e)
+print(json.dumps({{"seconds": time.perf_counter() - start, "network_calls": calls, "error": error}}))
+"""
+
+
+def probe(module: str, cwd: str) -> dict:
+    env = dict(os.environ)
+    # Clients need keys to be constructed, the values don't matter since nothing should be sent
+    env.setdefault("OPENAI_API_KEY", "sk-startup-benchmark")
+    env.setdefault("PINECONE_API_KEY", "startup-benchmark")
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module)], cwd=cwd, env=env,
+                            capture_output=True, text=True, timeout=300)
+    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if not lines:
+        return {"seconds": None, "network_calls": [], "error": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(lines[-1])
+
+
+def run(cwd: str, repeats: int) -> dict:
+    report = {}
+    for module in MODULES:
+        runs = [probe(module, cwd) for _ in range(repeats)]
+        timings = [r["seconds"] for r in runs if r["seconds"] is not None and r["error"] is None]
+        report[module] = {
+            "median_seconds": statistics.median(timings) if timings else None,
+            "network_calls": max(len(r["network_calls"]) for r in runs),
+            "errors": sorted({str(r["error"]) for r in runs if r["error"]}),
+        }
+    return report
+
+
+def print_report(label: str, report: dict) -> None:
+    print(f"\n{label}")
+    for module, stats in report.items():
+        seconds = "failed" if stats["median_seconds"] is None else f"{stats['median_seconds'] * 1000:8.1f} ms"
+        print(f"  {module:22s} import {seconds:>12s}   network calls during import: {stats['network_calls']}")
+        for error in stats["errors"]:
+            print(f"  {'':22s} error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and import-time network calls of the story modules")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--compare-ref", help="git ref to benchmark as the baseline, e.g. a commit before lazy init")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {"current": run(REPO_ROOT, args.repeats)}
+    print_report("Current tree", results["current"])
+
+    if args.compare_ref:
+        worktree = tempfile.mkdtemp(prefix="startup-benchmark-")
+        try:
+            subprocess.run(["git", "worktree", "add", "--detach", worktree, args.compare_ref], cwd=REPO_ROOT,
+                           check=True, capture_output=True)
+            results[args.compare_ref] = run(worktree, args.repeats)
+            print_report(f"Baseline {args.compare_ref}", results[args.compare_ref])
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=REPO_ROOT, capture_output=True)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
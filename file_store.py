@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+import uuid
+from typing import Callable
+
+from instrumentation import debug
+
+# Temporary files older than this were left behind by a process that died mid-write
+STALE_TMP_SECONDS = 3600
+
+
+class FileStore:
+    """Files named by key under one directory, bounded by total size and age.
+
+    Files are written under a temporary name and renamed into place, so concurrent writers (threads or worker
+    processes) never see a half-written file or overwrite each other. A file's mtime marks its last use; evict()
+    removes files unused for max_age seconds, the least recently used ones beyond max_mb and stale temporary files.
+    """
+
+    def __init__(self, directory: str, suffix: str, max_mb: float, max_age: float, evict_every: int = 20):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_mb * 2 ** 20
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    @staticmethod
+    def touch(path: str) -> bool:
+        # Marks a use of the file, False when it doesn't exist
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def write(self, key: str, write: Callable[[str], None]) -> str:
+        # write(tmp_path) creates the file, which then replaces the stored one for key. Returns the stored path.
+        path = self.path(key)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp{self.suffix}")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            self._remove(tmp_path)
+
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self.evict()
+        return path
+
+    def evict(self) -> int:
+        entries = []
+        now = time.time()
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in scan:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(f".tmp{self.suffix}"):
+                if now - stat.st_mtime > STALE_TMP_SECONDS:
+                    self._remove(entry.path)
+            elif entry.name.endswith(self.suffix):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort(reverse=True)
+        total = 0
+        removed = 0
+        for mtime, size, path in entries:
+            total += size
+            if total > self.max_bytes or (self.max_age and now - mtime > self.max_age):
+                self._remove(path)
+                removed += 1
+        if removed:
+            debug(f"Evicted {removed} files from {self.directory}")
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,17 +1,22 @@
+import gc
+import hashlib
 import os
 import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
 import numpy as np
 import PIL.Image as Image
-from PIL import ImageOps
 import torch
+import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 import spaces
-from diffusers import (
-    AutoencoderKL,
-    EulerAncestralDiscreteScheduler,
-    StableDiffusionXLAdapterPipeline,
-    T2IAdapter,
-)
+
+from file_store import FileStore
+from image_registry import get_image_registry
+from instrumentation import debug, info, metrics
+from llm_cache import cache_key
 
 style_list = [
     {
@@ -52,6 +57,30 @@ DEFAULT_STYLE_NAME = "(No style)"
 
 MAX_SEED = np.iinfo(np.int32).max
 
+# How many (sketch, prompt) pairs go through the pipeline in one call. Halved automatically on out-of-memory.
+IMAGE_BATCH_SIZE = int(os.getenv("IMAGE_BATCH_SIZE", "4"))
+
+SDXL_MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+
+# Sampler defaults per preset. "cpu" trades detail for time (fewer steps, smaller images); "turbo" swaps in the
+# distilled SDXL-Turbo weights, which are trained for a handful of steps without classifier-free guidance.
+IMAGE_PRESETS = {
+    "quality": {"model_id": SDXL_MODEL_ID, "num_steps": 25, "guidance_scale": 5.0, "resolution": 1024},
+    "cpu": {"model_id": SDXL_MODEL_ID, "num_steps": 12, "guidance_scale": 5.0, "resolution": 768},
+    "turbo": {"model_id": "stabilityai/sdxl-turbo", "num_steps": 4, "guidance_scale": 0.0, "resolution": 512},
+}
+IMAGE_PRESET = os.getenv("IMAGE_PRESET", "quality" if torch.cuda.is_available() else "cpu")
+# Weights dtype on CPU: "float32" works everywhere, "bfloat16" halves memory and is faster on CPUs with AVX512-BF16/AMX
+IMAGE_CPU_DTYPE = os.getenv("IMAGE_CPU_DTYPE", "float32")
+# Intra-op threads for CPU inference, 0 leaves torch's default (all cores)
+IMAGE_CPU_THREADS = int(os.getenv("IMAGE_CPU_THREADS", "0"))
+# Seconds without any image generation after which the pipeline is unloaded to free memory, 0 keeps it loaded
+IMAGE_PIPELINE_IDLE_UNLOAD = float(os.getenv("IMAGE_PIPELINE_IDLE_UNLOAD", "900"))
+# Generated images by content (sketch, styled prompt, sampler parameters), bounded in size and age since last use
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./.cache/images")
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "1024"))
+IMAGE_CACHE_MAX_AGE = float(os.getenv("IMAGE_CACHE_MAX_AGE", str(30 * 24 * 3600)))  # seconds, 0 means no expiry
+
 def apply_style(style_name: str, positive: str, negative: str = "") -> tuple[str, str]:
     p, n = styles.get(style_name, styles[DEFAULT_STYLE_NAME])
     return p.replace("{prompt}", positive), n + " " + negative
@@ -61,9 +90,12 @@ def randomize_seed_fn(seed: int, randomize_seed: bool) -> int:
         seed = random.randint(0, MAX_SEED)
     return seed
 
-def pad_image_to_multiple(image: Image.Image, multiple: int = 32) -> Image.Image:
-    """Pads the image symmetrically so its dimensions are divisible by the given multiple."""
-    width, height = image.size
+def pad_image_to_multiple(image, multiple: int = 32):
+    """Pads the image (PIL image or (..., H, W) tensor) symmetrically so its sides are divisible by multiple."""
+    if isinstance(image, torch.Tensor):
+        height, width = image.shape[-2:]
+    else:
+        width, height = image.size
     new_width = ((width + multiple - 1) // multiple) * multiple
     new_height = ((height + multiple - 1) // multiple) * multiple
 
@@ -75,23 +107,221 @@ def pad_image_to_multiple(image: Image.Image, multiple: int = 32) -> Image.Image
 
     return padded_image
 
+def load_sketches(paths: list, resolution: int) -> torch.Tensor:
+    """Decodes uploaded sketches into one (N, 3, H, W) float tensor of white strokes on black, the adapter's input."""
+    gray = [torch.from_numpy(np.array(Image.open(path).convert("L"))) for path in paths]
+    batch = torch.empty((len(gray), 1, resolution, resolution), dtype=torch.float32)
+    # Uploads of the same size (the usual case, they come from one drawing canvas) are resized in one call
+    by_size = {}
+    for i, image in enumerate(gray):
+        by_size.setdefault(tuple(image.shape), []).append(i)
+    for indices in by_size.values():
+        stacked = torch.stack([gray[i] for i in indices]).unsqueeze(1).to(torch.float32)
+        batch[indices] = F.interpolate(stacked, size=(resolution, resolution), mode="bicubic", align_corners=False,
+                                       antialias=True)
+    # Inverting and then keeping pixels above 0.5 is keeping the dark pixels of the original
+    sketches = (batch < 127.5).to(torch.float32).repeat(1, 3, 1, 1)
+    return pad_image_to_multiple(sketches)
+
+def is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+def run_pipeline_batched(pipe, prompts: list, negative_prompts: list, images: list, seeds: list, batch_size: int,
+                         **pipe_kwargs) -> list:
+    """Runs the pipeline over the pairs in micro-batches of batch_size, halving it when a batch runs out of memory."""
+    results = []
+    start = 0
+    while start < len(prompts):
+        end = min(start + batch_size, len(prompts))
+        # One generator per item, so an image depends on its own seed only, not on the batch it ended up in
+        generators = [torch.Generator(device=device).manual_seed(s) for s in seeds[start:end]]
+        try:
+            with torch.no_grad():
+                output = pipe(
+                    prompt=prompts[start:end],
+                    negative_prompt=negative_prompts[start:end],
+                    image=images[start:end],
+                    generator=generators,
+                    **pipe_kwargs
+                )
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or batch_size == 1:
+                raise
+            batch_size = max(1, batch_size // 2)
+            metrics.count("diffusion_oom_retries_total")
+            info(f"Out of memory, retrying with batch size {batch_size}")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            continue
+        results.extend(output.images)
+        start = end
+    return results
+
 # Initialize the model and pipeline
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-pipe = None  # Initialize pipe as None to avoid the error
+if IMAGE_PRESET not in IMAGE_PRESETS:
+    raise ValueError(f"Unknown IMAGE_PRESET: {IMAGE_PRESET}, expected one of {', '.join(IMAGE_PRESETS)}")
+preset = IMAGE_PRESETS[IMAGE_PRESET]
+
+def load_pipeline(device: torch.device, preset: dict) -> "StableDiffusionXLAdapterPipeline":
+    # diffusers itself takes seconds to import, so it is only imported when the pipeline is first needed
+    from diffusers import (
+        AutoencoderKL,
+        EulerAncestralDiscreteScheduler,
+        StableDiffusionXLAdapterPipeline,
+        T2IAdapter,
+    )
 
-if torch.cuda.is_available():
-    model_id = "stabilityai/stable-diffusion-xl-base-1.0"
-    adapter = T2IAdapter.from_pretrained("TencentARC/t2i-adapter-sketch-sdxl-1.0", torch_dtype=torch.float16, variant="fp16")
-    scheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
+    # fp16 on the GPU. CPUs have no fast fp16 kernels, so the fp16 weights are upcast to IMAGE_CPU_DTYPE there.
+    if device.type == "cuda":
+        dtype = torch.float16
+    else:
+        dtype = torch.bfloat16 if IMAGE_CPU_DTYPE == "bfloat16" else torch.float32
+        if IMAGE_CPU_THREADS > 0:
+            torch.set_num_threads(IMAGE_CPU_THREADS)
+
+    model_id = preset["model_id"]
+    adapter = T2IAdapter.from_pretrained("TencentARC/t2i-adapter-sketch-sdxl-1.0", torch_dtype=dtype, variant="fp16")
+    # The distilled turbo weights expect sampling to start from the last timestep
+    scheduler_kwargs = {"timestep_spacing": "trailing"} if model_id != SDXL_MODEL_ID else {}
+    scheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler", **scheduler_kwargs)
     pipe = StableDiffusionXLAdapterPipeline.from_pretrained(
         model_id,
-        vae=AutoencoderKL.from_pretrained("madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16),
+        vae=AutoencoderKL.from_pretrained("madebyollin/sdxl-vae-fp16-fix", torch_dtype=dtype),
         adapter=adapter,
         scheduler=scheduler,
-        torch_dtype=torch.float16,
+        torch_dtype=dtype,
         variant="fp16",
     )
     pipe.to(device)
+    return pipe
+
+# Seconds per denoising step per megapixel of output, per image. Starts from a rough figure for the device and is
+# replaced by measurements as images get generated, from concurrent requests, so updates take the lock.
+seconds_per_step_megapixel = 0.06 if device.type == "cuda" else 4.0
+_generation_rate_lock = threading.Lock()
+
+def estimate_generation_seconds(num_images: int, num_steps: int = None, resolution: int = None) -> float:
+    """Expected wall time of generate_images for num_images sketches with the current device and preset."""
+    num_steps = num_steps or preset["num_steps"]
+    resolution = resolution or preset["resolution"]
+    return num_images * num_steps * (resolution * resolution / 1e6) * seconds_per_step_megapixel
+
+def record_generation_time(seconds: float, num_images: int, num_steps: int, resolution: int) -> None:
+    global seconds_per_step_megapixel
+    measured = seconds / (num_images * num_steps * (resolution * resolution / 1e6))
+    # Moving average, so one slow first run (kernel compilation, page cache) doesn't dominate
+    with _generation_rate_lock:
+        seconds_per_step_megapixel = 0.7 * seconds_per_step_megapixel + 0.3 * measured
+
+class ImagePipelineManager:
+    """Process-wide SDXL + sketch adapter pipeline, loaded on first use and unloaded after idle_unload idle seconds.
+
+    Importing this module loads nothing. Call warmup() to load ahead of the first request; generate_images holds the
+    pipeline through use() so it is never unloaded mid-generation.
+    """
+
+    def __init__(self, device: torch.device, preset: dict, idle_unload: float = IMAGE_PIPELINE_IDLE_UNLOAD):
+        self.device = device
+        self.preset = preset
+        self.idle_unload = idle_unload
+        self._pipe = None
+        self._active = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pipe is None:
+                info(f"Loading image pipeline {self.preset['model_id']} on {self.device}")
+                with metrics.span("diffusion_load", device=self.device.type):
+                    self._pipe = load_pipeline(self.device, self.preset)
+            self._active += 1
+            pipe = self._pipe
+        try:
+            yield pipe
+        finally:
+            with self._lock:
+                self._active -= 1
+                if self._active == 0 and self.idle_unload > 0:
+                    self._timer = threading.Timer(self.idle_unload, self._unload_if_idle)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def warmup(self) -> None:
+        with self.use():
+            pass
+
+    def is_loaded(self) -> bool:
+        return self._pipe is not None
+
+    def _unload_if_idle(self) -> None:
+        with self._lock:
+            # A request may have come in (and gone) since this timer was started, then a newer timer is in charge
+            if self._active or self._timer is not threading.current_thread():
+                return
+            self._timer = None
+        self.unload()
+
+    def unload(self) -> None:
+        with self._lock:
+            if self._active or self._pipe is None:
+                return
+            self._pipe = None
+        info("Unloading image pipeline")
+        gc.collect()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+
+# One pipeline per process
+image_pipeline = ImagePipelineManager(device, preset)
+
+def warmup() -> None:
+    image_pipeline.warmup()
+
+
+class ImageCache(FileStore):
+    """Generated images as PNG files named by the hash of everything that determines them, in a FileStore bounded by
+    max_mb and max_age.
+
+    Pressing generate twice, or reloading, then costs a file read instead of a diffusion run.
+    """
+
+    def __init__(self, directory: str, max_mb: float = IMAGE_CACHE_MAX_MB, max_age: float = IMAGE_CACHE_MAX_AGE,
+                 evict_every: int = 20):
+        super().__init__(directory, ".png", max_mb, max_age, evict_every)
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+        except (FileNotFoundError, OSError):
+            return None
+        self.touch(path)
+        return image
+
+    def set(self, key: str, image: Image.Image) -> None:
+        self.write(key, lambda tmp_path: image.save(tmp_path, format="PNG"))
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR)
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def split_prompts(prompts_text: str) -> List[str]:
+    # One prompt per non-empty line, whitespace stripped
+    return [line.strip() for line in prompts_text.strip().split('\n') if line.strip()]
 
 @spaces.GPU
 def generate_images(
@@ -99,74 +329,101 @@ def generate_images(
     prompts_text: str,
     negative_prompt: str,
     style_name: str = DEFAULT_STYLE_NAME,
-    num_steps: int = 25,
-    guidance_scale: float = 5,
+    num_steps: int = None,
+    guidance_scale: float = None,
     adapter_conditioning_scale: float = 0.8,
     adapter_conditioning_factor: float = 0.8,
-    seed: int = 0
+    seed: int = 0,
+    batch_size: int = IMAGE_BATCH_SIZE,
+    use_cache: bool = True,
+    on_estimate: Optional[Callable[[float], None]] = None
 ):
-    if pipe is None:
-        raise RuntimeError("Stable Diffusion pipeline is not initialized. Please run on a system with CUDA support.")
+    # Returns the generated PIL images, one per prompt line. generate_and_register_images also stores them for a user.
+    # on_estimate is called with the expected seconds before any image is generated (not on a full cache hit), so the
+    # UI can tell the user how long a CPU run will take.
+    # Unset sampler parameters come from the preset, so CPU nodes default to fewer steps and smaller images
+    num_steps = num_steps or preset["num_steps"]
+    guidance_scale = preset["guidance_scale"] if guidance_scale is None else guidance_scale
+    resolution = preset["resolution"]
 
-    # Split prompts by lines and strip whitespace
-    prompts = [line.strip() for line in prompts_text.strip().split('\n') if line.strip()]
+    prompts = split_prompts(prompts_text)
     
     if len(uploaded_images) != len(prompts):
         raise ValueError("Number of uploaded images and prompts must match!")
 
-    prompt_image_dict = {}  # Dictionary to hold {original_prompt: generated_image}
-    generated_images = []
-
-    # Debugging: Print the number of uploaded images and prompts
-    print(f"Number of uploaded images: {len(uploaded_images)}")
-    print(f"Number of prompts: {len(prompts)}")
-    print(f"Prompts: {prompts}")
-        
-    generator = torch.Generator(device=device).manual_seed(seed)
+    debug(f"Number of uploaded images and prompts: {len(prompts)}")
 
     original_negative_prompt = negative_prompt
-    print(f"Negative prompts: {original_negative_prompt}")
 
-    for uploaded_image, prompt in zip(uploaded_images, prompts):
-        print(f"Processing prompt: {prompt}")  # Debugging to ensure prompt is a string
+    styled_prompts = []
+    styled_negative_prompts = []
+    for prompt in prompts:
+        # Apply style
+        prompt, negative_prompt = apply_style(style_name, prompt, original_negative_prompt)
+        styled_prompts.append(prompt)
+        styled_negative_prompts.append(negative_prompt)
 
-        negative_prompt = original_negative_prompt
-        # Store the original prompt before applying the style
-        original_prompt = prompt
+    sketch_paths = [uploaded_image.name for uploaded_image in uploaded_images]
+    # Image i uses seed + i whatever the batch size, so resubmitting the same doodles gives the same images
+    seeds = [seed + i for i in range(len(prompts))]
 
-        # Apply style
-        prompt, negative_prompt = apply_style(style_name, prompt, negative_prompt)
-
-        image = Image.open(uploaded_image.name).convert("L")
-        image = ImageOps.invert(image)
-        image = image.convert("RGB")
-
-        expected_width = 1024
-        expected_height = 1024
-        image = image.resize((expected_width, expected_height), Image.BICUBIC)
-
-        image_tensor = TF.to_tensor(image) > 0.5
-        image = TF.to_pil_image(image_tensor.to(torch.float32))
-
-        with torch.no_grad():
-            generated_image = pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=image,
-                num_inference_steps=num_steps,
-                generator=generator,
-                guidance_scale=guidance_scale,
-                adapter_conditioning_scale=adapter_conditioning_scale,
-                adapter_conditioning_factor=adapter_conditioning_factor
-            ).images[0]
-
-        # Debugging: Check shape of generated image
-        print(f"Generated Image Size: {generated_image.size}")
-        generated_images.append(generated_image)
-        # Add original prompt and generated image to dictionary
-        prompt_image_dict[original_prompt] = generated_image
-
-    # Print the dictionary for testing purposes
-    print(f"Prompt-Image Dictionary: {prompt_image_dict}")
-
-    return generated_images
\ No newline at end of file
+    # Everything that changes the output image is in the key
+    keys = [
+        cache_key(sketch=file_sha256(path), prompt=prompt, negative_prompt=negative, seed=item_seed,
+                  model=preset["model_id"], resolution=resolution, num_steps=num_steps, guidance_scale=guidance_scale,
+                  adapter_conditioning_scale=adapter_conditioning_scale,
+                  adapter_conditioning_factor=adapter_conditioning_factor)
+        for path, prompt, negative, item_seed in zip(sketch_paths, styled_prompts, styled_negative_prompts, seeds)
+    ]
+    generated_images = [image_cache.get(key) if use_cache else None for key in keys]
+    missing = [i for i, image in enumerate(generated_images) if image is None]
+    metrics.count("image_cache_hits_total", len(prompts) - len(missing))
+    metrics.count("image_cache_misses_total", len(missing))
+    debug(f"Image cache hits: {len(prompts) - len(missing)}/{len(prompts)}")
+
+    if missing:
+        estimate = estimate_generation_seconds(len(missing), num_steps)
+        metrics.gauge("diffusion_estimated_seconds", estimate, device=device.type)
+        debug(f"Estimated generation time on {device.type}: {estimate:.0f}s")
+        if on_estimate is not None:
+            on_estimate(estimate)
+        # All sketches in one tensor, the pipeline takes it as is (no PIL conversion on the way in)
+        with metrics.span("diffusion_preprocess"):
+            sketches = load_sketches([sketch_paths[i] for i in missing], resolution)
+
+        with image_pipeline.use() as pipe:
+            start = time.perf_counter()
+            with metrics.span("diffusion_inference", device=device.type):
+                new_images = run_pipeline_batched(
+                    pipe,
+                    [styled_prompts[i] for i in missing],
+                    [styled_negative_prompts[i] for i in missing],
+                    sketches,
+                    [seeds[i] for i in missing],
+                    max(1, batch_size),
+                    num_inference_steps=num_steps,
+                    guidance_scale=guidance_scale,
+                    adapter_conditioning_scale=adapter_conditioning_scale,
+                    adapter_conditioning_factor=adapter_conditioning_factor
+                )
+        metrics.count("images_generated_total", len(missing))
+        record_generation_time(time.perf_counter() - start, len(missing), num_steps, resolution)
+
+        for i, image in zip(missing, new_images):
+            generated_images[i] = image
+            if use_cache:
+                image_cache.set(keys[i], image)
+
+    return generated_images
+
+def generate_and_register_images(uploaded_images, prompts_text: str, negative_prompt: str, user_id: str,
+                                 **kwargs) -> List[str]:
+    # generate_images, then each image is stored once on disk under its original prompt for user_id, so the user's
+    # stories pick it up from the registry. Returns the stored paths. user_id has no default: images registered under
+    # the shared user are visible to everyone.
+    generated_images = generate_images(uploaded_images, prompts_text, negative_prompt, **kwargs)
+    registry = get_image_registry()
+    image_paths = [registry.register(user_id, prompt, image)
+                   for prompt, image in zip(split_prompts(prompts_text), generated_images)]
+    debug(f"Registered {len(image_paths)} images for user {user_id!r}")
+    return image_paths
\ No newline at end of file
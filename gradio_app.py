@@ -1,7 +1,18 @@
+import asyncio
+import concurrent.futures
 import re
+import threading
+import time
+import uuid
 import gradio as gr
-from story_generator import generate_bedtime_story
+from story_generator import (aspeculate_branches, astart_story_session, astory_session_step, story_state_from_dict,
+                             story_state_to_dict)
+from story_session import STORY_SESSION_TTL, SessionReaper, get_session_store, speculations
 from vector_db_operation import retrieve_existing_story_titles, summarize_and_upsert_story
+from speculation import get_speculation_stats
+from narration import NarrationSession
+from image_registry import get_image_registry
+from instrumentation import debug, error, metrics, start_metrics_server
 import audio_generator as ag
 import os
 from TTS.api import TTS 
@@ -9,22 +20,27 @@ from TTS.api import TTS
 # Import for handling images
 from PIL import Image
 
+# Opt-in: pre-generate the next segment for every offered choice while the child is choosing
+SPECULATIVE_STORIES = os.getenv("SPECULATIVE_STORIES", "false").lower() == "true"
+
 
 def create_interface():
     with gr.Blocks() as app:
         gr.Markdown("# Interactive Bedtime Story Generator")
 
-        story_generator_state = gr.State(None)
+        # The session id is kept in the page (a hidden textbox, sent back with every click) and the story itself in
+        # the session store, so any worker can take the next turn. gr.State lives in one process's memory and would
+        # tie the story to the worker that started it. Stories abandoned without End Story are dropped by the
+        # SessionReaper after STORY_SESSION_TTL idle seconds.
+        story_session_state = gr.Textbox(value="", visible=False)
+        # NarrationSession of the running story, None when not narrating. Live objects can't leave the process; if
+        # the next turn lands on another worker that turn is simply not narrated.
+        # Gradio drops it when the tab is closed or after STORY_SESSION_TTL idle seconds, which stops the narration.
+        narration_state = gr.State(None, time_to_live=STORY_SESSION_TTL or None,
+                                   delete_callback=lambda narration: narration.close() if narration else None)
         user_id = gr.Textbox(label="User ID")
-
-        # State variables for images
-        generated_images = gr.State({
-            "eye-monster": "images/eye-monster.png",
-            "magic-cupcake": "images/magic-cupcake.png",
-            "purple-unicorn": "images/purple-unicorn.png"
-        })  # Placeholder for testing purposes. When ready it would be called into the parameter of this function above. @ LINH
-        image_descriptions = gr.State(
-            ["eye-monster", "magic-cupcake", "purple-unicorn"])  # Hard coded placeholder for now. @ LINH
+        # Each segment is narrated in the background while the child reads it, leave empty for no narration
+        narrator = gr.Dropdown(choices=ag.get_speaker_names(), value=None, label="Narrator Voice (optional)")
 
         with gr.Tabs():
             with gr.TabItem("New Story"):
@@ -65,12 +81,19 @@ def create_interface():
                 # Audio output 
                 audio_output = gr.Audio(label="Generated Audio")
 
+                # Streaming narration, starts playing after the first sentence
+                stream_button = gr.Button("Stream Audio")
+                stream_output = gr.Audio(label="Streamed Audio", streaming=True, autoplay=True)
+
                 ### Button actions ###
                 # Save Recording button action
-                save_button.click(ag.save_recording, inputs=[audio_input], outputs=speaker_dropdown)
+                save_button.click(ag.save_recording, inputs=[audio_input, user_id], outputs=speaker_dropdown)
 
                 # Generate Audio button press action
-                generate_button.click(ag.generate_audio, inputs=[text_input, speaker_dropdown], outputs=audio_output)
+                generate_button.click(ag.generate_audio, inputs=[text_input, speaker_dropdown, user_id], outputs=audio_output)
+
+                # Stream Audio button press action, ag.stream_audio is a generator so Gradio streams each chunk
+                stream_button.click(ag.stream_audio, inputs=[text_input, speaker_dropdown, user_id], outputs=stream_output)
 
                 
 
@@ -83,6 +106,7 @@ def create_interface():
             custom_choice = gr.Textbox(label="Or enter your own choice")
             submit_custom = gr.Button("Submit Custom Choice")
             end_button = gr.Button("End Story")
+            narration_audio = gr.Audio(label="Narration", autoplay=True)
 
         # New: Save and Main Menu buttons
         save_story_btn = gr.Button("Save Story", visible=False)
@@ -91,8 +115,8 @@ def create_interface():
         def update_end_button(story_complete):
             return gr.update(value="Back to Main Menu" if story_complete else "End Story")
 
-        def update_story_choices(user_id):
-            stories = retrieve_existing_story_titles(user_id)
+        async def update_story_choices(user_id):
+            stories = await asyncio.to_thread(retrieve_existing_story_titles, user_id)
             return gr.Dropdown(choices=[story[0] for story in stories], value=stories[0][0] if stories else None)
 
         def update_choices(choices):
@@ -104,48 +128,132 @@ def create_interface():
                     updates.append(gr.update(visible=False))
             return updates
 
-        def handle_choice(choice, story_generator):
-            print(f"Debug: handle_choice called with choice: {choice}")
+        def queue_narration(narration, story_data):
+            # Queues the segment on the narration workers as soon as the story engine yields it
+            if narration is not None:
+                narration.narrate(segment_text(story_data))
+
+        async def play_narration(narration):
+            # Chained after each story turn as its own event, so the turn's event ends once the segment is shown and
+            # doesn't stay open for the whole synthesis. Waits for the newest segment's audio without blocking the
+            # event loop; the player is left alone when not narrating, the queue was full, synthesis failed, or a
+            # newer segment superseded this one.
+            future = narration.latest if narration is not None else None
+            if future is None:
+                return gr.update()
+            try:
+                audio_path = await asyncio.wrap_future(future)
+            except (asyncio.CancelledError, concurrent.futures.CancelledError):
+                if not future.cancelled():
+                    raise
+                return gr.update()
+            except Exception as e:
+                metrics.count("narration_errors_total")
+                error(f"Narration failed: {str(e)}")
+                return gr.update()
+            return audio_path if narration.is_latest(future) else gr.update()
+
+        def close_narration(narration):
+            if narration is not None:
+                narration.close()
+
+        async def load_session(session_id):
+            # (story state, version), (None, None) when there is no such session
+            if not session_id:
+                return None, None
+            data, version = await asyncio.to_thread(get_session_store().get_versioned, session_id)
+            return (story_state_from_dict(data), version) if data is not None else (None, None)
+
+        async def save_session(session_id, state, version=None):
+            # With the version the state was loaded at, False when another turn was stored in the meantime
+            return await asyncio.to_thread(get_session_store().put, session_id, story_state_to_dict(state), version)
+
+        async def end_session(session_id):
+            if not session_id:
+                return
+            speculations.discard(session_id)
+            await asyncio.to_thread(get_session_store().delete, session_id)
+
+        async def handle_choice(choice, session_id, narration, user_id):
+            debug(f"handle_choice called with choice: {choice}")
+            turn_start = time.perf_counter()
+            speculations.reap()
             try:
-                if story_generator is None:
-                    print("Debug: No active story generator")
-                    return {
+                state, version = await load_session(session_id)
+                if state is None:
+                    debug("No active story session")
+                    close_narration(narration)
+                    yield {
                         story_display: "No active story. Please start a new story or continue an existing one.",
                         image_display: [],
                         choice_buttons[0]: gr.update(visible=False),
                         choice_buttons[1]: gr.update(visible=False),
                         choice_buttons[2]: gr.update(visible=False),
-                        story_generator_state: None,
+                        story_session_state: None,
                         custom_choice: gr.update(value="", visible=False),
                         submit_custom: gr.update(visible=False),
                         save_story_btn: gr.update(visible=False),
                         main_menu_btn: gr.update(visible=False),
-                        end_button: gr.update(visible=False)
+                        end_button: gr.update(visible=False),
+                        narration_state: None
                     }
+                    return
 
                 if choice.lower() == 'exit story':
-                    print("Debug: User requested to exit story")
-                    return {
+                    debug("User requested to exit story")
+                    close_narration(narration)
+                    await end_session(session_id)
+                    yield {
                         story_display: "Story ended by user request.",
                         image_display: [],
                         choice_buttons[0]: gr.update(visible=False),
                         choice_buttons[1]: gr.update(visible=False),
                         choice_buttons[2]: gr.update(visible=False),
-                        story_generator_state: None,
+                        story_session_state: None,
                         custom_choice: gr.update(value=""),  # Clear the input field
                         save_story_btn: gr.update(visible=True),
                         main_menu_btn: gr.update(visible=True),
-                        end_button: gr.update(visible=False)
+                        end_button: gr.update(visible=False),
+                        narration_state: None
                     }
-
-                print("Debug: Sending choice to generator")
-                next_segment = story_generator.send(choice)
-                print(f"Debug: Received next segment: {next_segment}")
+                    return
+
+                debug("Applying choice to the story session")
+                # Pre-generated by this worker while the child was choosing, None otherwise
+                part = await speculations.take(session_id, choice)
+                next_segment = None
+                first_text = True
+                async for item in astory_session_step(state, choice, stream=True, part=part):
+                    if item.get('partial', False):
+                        if first_text:
+                            metrics.observe("story_turn_first_text_seconds", time.perf_counter() - turn_start,
+                                            kind="choice")
+                            first_text = False
+                        # Push the streamed text to the story panel as it comes in, buttons stay hidden until it is done
+                        yield {
+                            story_display: item['partial_text'],
+                            choice_buttons[0]: gr.update(visible=False),
+                            choice_buttons[1]: gr.update(visible=False),
+                            choice_buttons[2]: gr.update(visible=False)
+                        }
+                    else:
+                        next_segment = item
+                        queue_narration(narration, next_segment)
+                # Time until the whole segment is in, narration and the UI update are not part of it
+                metrics.observe("story_turn_seconds", time.perf_counter() - turn_start, kind="choice",
+                                speculated=part is not None)
+                debug(f"Received segment {len(next_segment['segments'])}, total tokens: {next_segment['total_tokens']}")
+                if SPECULATIVE_STORIES:
+                    debug(f"Speculation stats: {get_speculation_stats()}")
 
                 if next_segment.get('complete', False):
-                    print("Debug: Story completed")
-                    images, text, _ = display_story_segment(next_segment, generated_images.value)
-                    return {
+                    debug("Story completed")
+                    await end_session(session_id)
+                    # The last segment is still narrated, there is just nothing more to queue
+                    if narration is not None:
+                        narration.finish()
+                    images, text, _ = await display_story_segment(next_segment, user_id)
+                    yield {
                         #story_display: next_segment['story'], this shows full story all again at the end
                         #image_display: next_segment['segments'][-1].get('images', []),
                         story_display: next_segment['segments'][-1]['text'],
@@ -153,98 +261,144 @@ def create_interface():
                         choice_buttons[0]: gr.update(visible=False),
                         choice_buttons[1]: gr.update(visible=False),
                         choice_buttons[2]: gr.update(visible=False),
-                        story_generator_state: None,
+                        story_session_state: None,
                         custom_choice: gr.update(value="", visible=False),
                         submit_custom: gr.update(visible=False),
                         save_story_btn: gr.update(visible=True),
                         main_menu_btn: gr.update(visible=True),
                         end_button: gr.update(visible=False)
                     }
-
-                images, text, choices = display_story_segment(next_segment, generated_images.value)
+                    return
+
+                if not await save_session(session_id, state, version):
+                    # Another turn on this story (a double click, a second tab) was stored first. That one counts,
+                    # so this segment is dropped and the stored one is shown instead.
+                    debug("Story session changed during this turn, showing the stored segment")
+                    state, _ = await load_session(session_id)
+                    if state is None:
+                        # That turn finished (or ended) the story and deleted the session, so this one ends it too
+                        close_narration(narration)
+                        yield {
+                            story_display: "The story has concluded.",
+                            image_display: [],
+                            choice_buttons[0]: gr.update(visible=False),
+                            choice_buttons[1]: gr.update(visible=False),
+                            choice_buttons[2]: gr.update(visible=False),
+                            story_session_state: None,
+                            custom_choice: gr.update(value="", visible=False),
+                            submit_custom: gr.update(visible=False),
+                            save_story_btn: gr.update(visible=True),
+                            main_menu_btn: gr.update(visible=True),
+                            end_button: gr.update(visible=False),
+                            narration_state: None
+                        }
+                        return
+                    next_segment = {"segments": state["segments"], "choices": state["segments"][-1]["choices"]}
+                    queue_narration(narration, next_segment)
+                elif SPECULATIVE_STORIES:
+                    speculations.start(session_id, aspeculate_branches(state, next_segment))
+
+                images, text, choices = await display_story_segment(next_segment, user_id)
                 choice_updates = update_choices(choices)
 
-                return {
+                yield {
                     image_display: images,
                     story_display: text,
                     choice_buttons[0]: choice_updates[0],
                     choice_buttons[1]: choice_updates[1],
                     choice_buttons[2]: choice_updates[2],
-                    story_generator_state: story_generator,
+                    story_session_state: session_id,
                     custom_choice: gr.update(value="", visible=True),
                     submit_custom: gr.update(visible=True),
                     save_story_btn: gr.update(visible=False),
                     main_menu_btn: gr.update(visible=False),
                     end_button: gr.update(visible=True)
-                    # add audio button 
-                }
-            except StopIteration:
-                print("Debug: StopIteration caught, ending story")
-                return {
-                    story_display: "The story has concluded.",
-                    image_display: [],
-                    choice_buttons[0]: gr.update(visible=False),
-                    choice_buttons[1]: gr.update(visible=False),
-                    choice_buttons[2]: gr.update(visible=False),
-                    story_generator_state: None,
-                    custom_choice: gr.update(value=""),  # Clear the input field
-                    save_story_btn: gr.update(visible=True),
-                    main_menu_btn: gr.update(visible=True)
-                    # add audio button 
                 }
             except Exception as e:
-                print(f"Debug: Unexpected error in handle_choice: {str(e)}")
-                return {
+                metrics.count("story_turn_errors_total", kind="choice")
+                error(f"Unexpected error in handle_choice: {str(e)}")
+                close_narration(narration)
+                await end_session(session_id)
+                yield {
                     story_display: f"An error occurred: {str(e)}",
                     image_display: [],
                     choice_buttons[0]: gr.update(visible=False),
                     choice_buttons[1]: gr.update(visible=False),
                     choice_buttons[2]: gr.update(visible=False),
-                    story_generator_state: None,
+                    story_session_state: None,
                     custom_choice: gr.update(value="", visible=False),
                     submit_custom: gr.update(visible=False),
                     save_story_btn: gr.update(visible=False),
                     main_menu_btn: gr.update(visible=True),
-                    end_button: gr.update(visible=False)
-                    # add audio button 
+                    end_button: gr.update(visible=False),
+                    narration_state: None
                 }
 
-        def start_or_continue_story(user_id, is_new, *args):  # This is what kicks things of.
+        async def start_or_continue_story(user_id, narrator, is_new, *args):  # This is what kicks things of.
+            narration = NarrationSession(narrator, user_id) if narrator else None
+            session_id = uuid.uuid4().hex
+            turn_start = time.perf_counter()
+            first_text = True
+            speculations.reap()
             try:
                 if is_new:
                     name, place, tone, moral, length, age = args
-                    story_generator = generate_bedtime_story(user_id, image_descriptions.value, is_continued=False,
-                                                             name=name, place=place,
-                                                             tone=tone, moral=moral, length=float(length), age=int(age))# add audio button
+                    state = await astart_story_session(user_id, is_continued=False,
+                                                       name=name, place=place,
+                                                       tone=tone, moral=moral, length=float(length), age=int(age))# add audio button
                 else:
                     story_choice, tone, moral, length = args
-                    story_generator = generate_bedtime_story(user_id, image_descriptions.value, is_continued=True,
-                                                             story_choice=story_choice,
-                                                             tone=tone, moral=moral, length=float(length))# add audio button
-
-                first_segment = next(story_generator)
-                images, text, choices = display_story_segment(first_segment, generated_images.value)
+                    state = await astart_story_session(user_id, is_continued=True,
+                                                       story_choice=story_choice,
+                                                       tone=tone, moral=moral, length=float(length))# add audio button
+
+                first_segment = None
+                async for item in astory_session_step(state, stream=True):
+                    if item.get('partial', False):
+                        if first_text:
+                            metrics.observe("story_turn_first_text_seconds", time.perf_counter() - turn_start,
+                                            kind="start")
+                            first_text = False
+                        yield {
+                            story_interface: gr.update(visible=True),
+                            story_display: item['partial_text'],
+                            choice_buttons[0]: gr.update(visible=False),
+                            choice_buttons[1]: gr.update(visible=False),
+                            choice_buttons[2]: gr.update(visible=False)
+                        }
+                    else:
+                        first_segment = item
+                        queue_narration(narration, first_segment)
+                metrics.observe("story_turn_seconds", time.perf_counter() - turn_start, kind="start",
+                                speculated=False)
+                await save_session(session_id, state)
+                if SPECULATIVE_STORIES:
+                    speculations.start(session_id, aspeculate_branches(state, first_segment))
+
+                images, text, choices = await display_story_segment(first_segment, user_id)
                 choice_updates = update_choices(choices)
-                return {
+                yield {
                     story_interface: gr.update(visible=True),
                     image_display: images,
-                    # story_display: text,  This would display all the story until latest segment
-                    story_display: text.split('\n\n')[-1],  # This will display only the last paragraph
+                    story_display: text,  # the segment the partial updates streamed, as in handle_choice
                     choice_buttons[0]: choice_updates[0],
                     choice_buttons[1]: choice_updates[1],
                     choice_buttons[2]: choice_updates[2],
                     custom_choice: gr.update(value="", visible=True),
                     submit_custom: gr.update(visible=True),
-                    story_generator_state: story_generator,
+                    story_session_state: session_id,
                     save_story_btn: gr.update(visible=False),
                     main_menu_btn: gr.update(visible=False),
-                    end_button: gr.update(visible=True)
-                    # add audio button 
+                    end_button: gr.update(visible=True),
+                    narration_state: narration
                 }
 
             except Exception as e:
-                print(f"Debug: Error in start_or_continue_story: {str(e)}")
-                return {
+                metrics.count("story_turn_errors_total", kind="start")
+                error(f"Error in start_or_continue_story: {str(e)}")
+                close_narration(narration)
+                await end_session(session_id)
+                yield {
                     story_interface: gr.update(visible=True),
                     story_display: f"An error occurred: {str(e)}",
                     image_display: [],
@@ -253,21 +407,41 @@ def create_interface():
                     choice_buttons[2]: gr.update(visible=False),
                     custom_choice: gr.update(value="", visible=False),
                     submit_custom: gr.update(visible=False),
-                    story_generator_state: None,
+                    story_session_state: None,
                     save_story_btn: gr.update(visible=False),
-                    main_menu_btn: gr.update(visible=True)
-                    # add audio button 
+                    main_menu_btn: gr.update(visible=True),
+                    narration_state: None
                 }
 
-        def save_story(user_id, story_text, name, place):
+        async def save_story(user_id, story_text, name, place):
             try:
-                summarize_and_upsert_story(user_id, name, story_text, place)
-                print(f"Story for {name} in {place} has been saved and upserted.")
+                with metrics.span("story_save"):
+                    await asyncio.to_thread(summarize_and_upsert_story, user_id, name, story_text, place)
+                debug(f"Story for {name} in {place} has been saved and upserted.")
                 return "Story saved successfully!", gr.update(visible=False), gr.update(visible=True)
             except Exception as e:
-                print(f"Error saving story: {str(e)}")
+                error(f"Error saving story: {str(e)}")  # counted by the story_save span
                 return f"Error saving story: {str(e)}", gr.update(visible=True), gr.update(visible=True)
 
+        async def end_story(session_id, narration):
+            # Queued narration for this story is cancelled, nobody is left to listen to it
+            close_narration(narration)
+            await end_session(session_id)
+            return {
+                story_interface: gr.update(visible=False),
+                image_display: [],
+                story_display: "The story has concluded.",
+                choice_buttons[0]: gr.update(visible=False),
+                choice_buttons[1]: gr.update(visible=False),
+                choice_buttons[2]: gr.update(visible=False),
+                story_session_state: None,
+                custom_choice: gr.update(value="", visible=False),
+                submit_custom: gr.update(visible=False),
+                end_button: gr.update(value="Back to Main Menu"),
+                narration_state: None,
+                narration_audio: None
+            }
+
         def back_to_main_menu():
             return {
                 story_interface: gr.update(visible=False),
@@ -275,81 +449,78 @@ def create_interface():
                 main_menu_btn: gr.update(visible=False)
             }
 
-        def display_story_segment(story_data, generated_images_dict):
-            print(f"Debug: display_story_segment called with: {story_data}")
+        def segment_text(story_data):
+            # Extract the text between <segment> tags placed in generate_story_part
+            text = story_data['segments'][-1]['text']
+            text_match = re.search(r'<segment>(.*?)</segment>', text, re.DOTALL)
+            if text_match:
+                return text_match.group(1).strip()
+            return text  # Fallback to the entire text if no tags found
+
+        async def display_story_segment(story_data, user_id):
             if not story_data or 'segments' not in story_data or not story_data['segments']:
-                print("Debug: No story segments available.")
+                debug("No story segments available.")
                 return [], "No story segments available.", []
 
             segment = story_data['segments'][-1]
-
-            # Extract the text between <segment> tags placed in generate_story_part
-            text_match = re.search(r'<segment>(.*?)</segment>', segment['text'], re.DOTALL)
-            if text_match:
-                text = text_match.group(1).strip()
-            else:
-                text = segment['text']  # Fallback to the entire text if no tags found
+            text = segment_text(story_data)
 
             segment_image_descriptions = segment.get('images', [])
-            images = [generated_images_dict.get(img, None) for img in segment_image_descriptions]
+            # Thumbnails of the images the story engine picked from the user's registry. The first call registers and
+            # thumbnails the bundled images, so the registry is only touched from a thread.
+            images = await asyncio.to_thread(lambda: get_image_registry().gallery(user_id, segment_image_descriptions))
             choices = story_data.get('choices', [])  # Modified
             # choices = segment.get('choices', []) old.
             return images, text, choices
 
         user_id.change(update_story_choices, inputs=[user_id], outputs=[story_choice])
+        # Voices a user recorded are only offered to that user
+        user_id.change(lambda user_id: (ag.refresh_speaker_list(user_id), ag.refresh_speaker_list(user_id)),
+                       inputs=[user_id], outputs=[speaker_dropdown, narrator])
 
         new_story_btn.click(
             start_or_continue_story,
-            inputs=[user_id, gr.State(True), name, place, tone, moral, length, age],
+            inputs=[user_id, narrator, gr.State(True), name, place, tone, moral, length, age],
             outputs=[story_interface, image_display, story_display] + choice_buttons + [custom_choice, submit_custom,
-                                                                                        story_generator_state,
-                                                                                        save_story_btn, main_menu_btn,
-                                                                                        end_button]
-        )
+                                                                                         story_session_state,
+                                                                                         save_story_btn, main_menu_btn,
+                                                                                         end_button, narration_state]
+        ).then(play_narration, inputs=[narration_state], outputs=[narration_audio], concurrency_limit=None)
 
         continue_btn.click(
             start_or_continue_story,
-            inputs=[user_id, gr.State(False), story_choice, cont_tone, cont_moral, cont_length],
+            inputs=[user_id, narrator, gr.State(False), story_choice, cont_tone, cont_moral, cont_length],
             outputs=[story_interface, image_display, story_display] + choice_buttons + [custom_choice, submit_custom,
-                                                                                        story_generator_state,
-                                                                                        save_story_btn, main_menu_btn,
-                                                                                        end_button]
-        )
+                                                                                         story_session_state,
+                                                                                         save_story_btn, main_menu_btn,
+                                                                                         end_button, narration_state]
+        ).then(play_narration, inputs=[narration_state], outputs=[narration_audio], concurrency_limit=None)
 
         for button in choice_buttons:
             button.click(
                 handle_choice,
-                inputs=[button, story_generator_state],
-                outputs=[image_display, story_display] + choice_buttons + [story_generator_state, custom_choice,
-                                                                           submit_custom, save_story_btn, main_menu_btn,
-                                                                           end_button]
-            )
+                inputs=[button, story_session_state, narration_state, user_id],
+                outputs=[image_display, story_display] + choice_buttons + [story_session_state, custom_choice,
+                                                                            submit_custom, save_story_btn, main_menu_btn,
+                                                                            end_button, narration_state]
+            ).then(play_narration, inputs=[narration_state], outputs=[narration_audio], concurrency_limit=None)
 
         submit_custom.click(
             handle_choice,
-            inputs=[custom_choice, story_generator_state],
-            outputs=[image_display, story_display] + choice_buttons + [story_generator_state, custom_choice,
-                                                                       submit_custom, save_story_btn, main_menu_btn,
-                                                                       end_button]
-        )
+            inputs=[custom_choice, story_session_state, narration_state, user_id],
+            outputs=[image_display, story_display] + choice_buttons + [story_session_state, custom_choice,
+                                                                        submit_custom, save_story_btn, main_menu_btn,
+                                                                        end_button, narration_state]
+        ).then(play_narration, inputs=[narration_state], outputs=[narration_audio], concurrency_limit=None)
 
         end_button.click(
-            lambda: {
-                story_interface: gr.update(visible=False),
-                image_display: [],
-                story_display: "The story has concluded.",
-                choice_buttons[0]: gr.update(visible=False),
-                choice_buttons[1]: gr.update(visible=False),
-                choice_buttons[2]: gr.update(visible=False),
-                story_generator_state: None,
-                custom_choice: gr.update(value="", visible=False),
-                submit_custom: gr.update(visible=False),
-                end_button: gr.update(value="Back to Main Menu")
-            },
-            outputs=[story_interface, image_display, story_display] + choice_buttons + [story_generator_state,
-                                                                                        custom_choice, submit_custom,
-                                                                                        end_button, save_story_btn,
-                                                                                        main_menu_btn]
+            end_story,
+            inputs=[story_session_state, narration_state],
+            outputs=[story_interface, image_display, story_display] + choice_buttons + [story_session_state,
+                                                                                         custom_choice, submit_custom,
+                                                                                         end_button, save_story_btn,
+                                                                                         main_menu_btn, narration_state,
+                                                                                         narration_audio]
         )
 
         save_story_btn.click(
@@ -363,9 +534,39 @@ def create_interface():
             outputs=[story_interface, save_story_btn, main_menu_btn]
         )
 
+        # The story handlers and the components their updates are keyed by, so they can be driven without a browser
+        # (benchmarks/load_test.py)
+        app.handlers = {
+            "start_or_continue_story": start_or_continue_story,
+            "handle_choice": handle_choice,
+            "play_narration": play_narration,
+            "save_story": save_story,
+            "end_story": end_story
+        }
+        app.story_components = {
+            "story_display": story_display,
+            "choice_buttons": choice_buttons,
+            "story_session_state": story_session_state,
+            "narration_state": narration_state,
+            "narration_audio": narration_audio
+        }
+
     return app
 
 
 if __name__ == "__main__":
+    if os.getenv("TTS_WARMUP", "false").lower() == "true":
+        # Load the TTS model in the background so the first narration doesn't pay for it
+        threading.Thread(target=ag.model_manager.warmup, daemon=True).start()
+    # Drops stories abandoned without pressing End Story and logs how many sessions are live
+    session_reaper = SessionReaper(get_session_store())
+    session_reaper.start()
+    # Per-stage latency and token counters on METRICS_PORT (/metrics, /metrics.json), off when it is unset
+    start_metrics_server()
     interface = create_interface()
-    interface.launch()
+    # Handlers are async, so one process can serve many stories at once instead of Gradio's default of one per event
+    interface.queue(default_concurrency_limit=int(os.getenv("GRADIO_CONCURRENCY_LIMIT", "200")))
+    try:
+        interface.launch()
+    finally:
+        session_reaper.close()
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from sqlite_util import ThreadLocalConnection
+
+# Generated images, stored once on disk and looked up by (user, description). The story engine takes its image
+# descriptions from here and the UI shows the stored files, so nothing keeps PIL images around per session.
+IMAGE_REGISTRY_DIR = os.getenv("IMAGE_REGISTRY_DIR", "./generated_images")
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "256"))
+# Images shipped with the app, offered to users who haven't generated any of their own yet
+DEFAULT_IMAGE_DIR = "./images"
+
+SHARED_USER = ""
+
+
+class ImageRegistry:
+    """Prompt -> image registry: image files named by their content hash, a thumbnail for each, and a SQLite table
+    mapping (user_id, description) to them.
+
+    Registering the same image twice stores it once. A user's own image wins over a shared one with the same
+    description.
+    """
+
+    def __init__(self, directory: str, thumbnail_size: int = IMAGE_THUMBNAIL_SIZE):
+        self.directory = directory
+        self.thumbnail_size = thumbnail_size
+        self._connection = ThreadLocalConnection(os.path.join(directory, "registry.sqlite3"))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS images (user_id TEXT NOT NULL, description TEXT NOT NULL, "
+                         "path TEXT NOT NULL, thumbnail_path TEXT NOT NULL, created_at REAL NOT NULL, "
+                         "PRIMARY KEY (user_id, description))")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_by_user ON images (user_id, created_at)")
+
+
+    def _store(self, image: Image.Image) -> Tuple[str, str]:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        data = buffer.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, f"{digest}.png")
+        thumbnail_path = os.path.join(self.directory, f"{digest}_thumb.png")
+        if not os.path.exists(path):
+            # Temp file and rename, so a concurrent reader never gets a half-written image
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        if not os.path.exists(thumbnail_path):
+            thumbnail = image.copy()
+            thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            tmp_path = f"{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            thumbnail.save(tmp_path, format="PNG")
+            os.replace(tmp_path, thumbnail_path)
+        return path, thumbnail_path
+
+    def register(self, user_id: str, description: str, image) -> str:
+        # image is a PIL image or a path to one, returns the path of the stored image
+        if isinstance(image, str):
+            with Image.open(image) as opened:
+                path, thumbnail_path = self._store(opened)
+        else:
+            path, thumbnail_path = self._store(image)
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO images (user_id, description, path, thumbnail_path, created_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (user_id or SHARED_USER, description, path, thumbnail_path,
+                                                    time.time()))
+        return path
+
+    def register_defaults(self, directory: str = DEFAULT_IMAGE_DIR) -> None:
+        # The bundled images become shared entries, described by their file names ("eye-monster")
+        if not os.path.isdir(directory) or self.descriptions(SHARED_USER):
+            return
+        for file in sorted(os.listdir(directory)):
+            if file.endswith(".png"):
+                self.register(SHARED_USER, os.path.splitext(file)[0], os.path.join(directory, file))
+
+    def descriptions(self, user_id: str) -> List[str]:
+        # The user's images, most recently generated first, the shared ones when they have none
+        conn = self._connection()
+        rows = conn.execute("SELECT description FROM images WHERE user_id = ? ORDER BY created_at DESC",
+                            (user_id or SHARED_USER,)).fetchall()
+        if not rows and user_id:
+            rows = conn.execute("SELECT description FROM images WHERE user_id = ? ORDER BY created_at DESC",
+                                (SHARED_USER,)).fetchall()
+        return [description for description, in rows]
+
+    def _lookup(self, user_id: str, description: str) -> Optional[Tuple[str, str]]:
+        return self._connection().execute(
+            "SELECT path, thumbnail_path FROM images WHERE description = ? AND user_id IN (?, ?) "
+            "ORDER BY user_id = ? LIMIT 1",  # the user's own image first
+            (description, user_id or SHARED_USER, SHARED_USER, SHARED_USER)
+        ).fetchone()
+
+    def image_path(self, user_id: str, description: str) -> Optional[str]:
+        row = self._lookup(user_id, description)
+        return row[0] if row else None
+
+    def thumbnail_path(self, user_id: str, description: str) -> Optional[str]:
+        row = self._lookup(user_id, description)
+        return row[1] if row else None
+
+    def gallery(self, user_id: str, descriptions: List[str]) -> List[Tuple[str, str]]:
+        # (thumbnail path, description) pairs for a gr.Gallery, descriptions without an image are left out
+        items = []
+        for description in descriptions:
+            thumbnail_path = self.thumbnail_path(user_id, description)
+            if thumbnail_path:
+                items.append((thumbnail_path, description))
+        return items
+
+
+@lru_cache(maxsize=None)
+def get_image_registry() -> ImageRegistry:
+    registry = ImageRegistry(IMAGE_REGISTRY_DIR)
+    registry.register_defaults()
+    return registry
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+# "prometheus" (default) keeps counters and latency histograms in the process, "json" also appends every span as a
+# JSON line to METRICS_JSON_LOG, "off" turns every call into a no-op.
+METRICS_MODE = os.getenv("METRICS_MODE", "prometheus").lower()
+METRICS_JSON_LOG = os.getenv("METRICS_JSON_LOG", "./.cache/metrics.jsonl")
+# Serve /metrics (Prometheus text) and /metrics.json on this port, 0 means no endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# The "Debug: ..." output of the story engine and the app, off unless asked for
+DEBUG_LOGS = os.getenv("DEBUG_LOGS", "false").lower() == "true"
+
+# Latency buckets in seconds, from a cache hit up to a diffusion run on CPU
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+# Operational messages and errors, always on. Errors raised inside an except block carry their traceback.
+logger = logging.getLogger("alchemy_art")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def debug(message: str) -> None:
+    if DEBUG_LOGS:
+        print(f"Debug: {message}")
+
+
+def info(message: str) -> None:
+    logger.info(message)
+
+
+def error(message: str) -> None:
+    logger.error(message, exc_info=sys.exc_info()[0] is not None)
+
+
+def _labels_key(labels: Dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + list(extra or ())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """Process-wide counters and latency histograms, keyed by metric name and labels.
+
+    span() times a block and records it as the <name>_seconds histogram, count() adds to a counter and gauge() sets a
+    current value. Each takes a lock for a dict update, so they are cheap enough for every LLM call and story turn.
+    """
+
+    def __init__(self, json_log: Optional[str] = None):
+        self.json_log = json_log
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+        if json_log:
+            os.makedirs(os.path.dirname(os.path.abspath(json_log)), exist_ok=True)
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(BUCKETS)] += 1
+            histogram[-1] += seconds
+        if self.json_log:
+            # Appends of one short line don't interleave, so the file needs no lock of its own
+            line = json.dumps({"time": time.time(), "metric": name, "seconds": seconds, **labels}) + "\n"
+            with open(self.json_log, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            # Cancellation (CancelledError, GeneratorExit of an abandoned stream) is timed but isn't an error
+            self.count(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict:
+        # {"counters": {"name{labels}": value}, "gauges": {"name{labels}": value},
+        #  "histograms": {"name{labels}": {"count", "sum", "mean"}}}
+        with self._lock:
+            counters = {name + _format_labels(labels): value for (name, labels), value in self._counters.items()}
+            gauges = {name + _format_labels(labels): value for (name, labels), value in self._gauges.items()}
+            histograms = {}
+            for (name, labels), histogram in self._histograms.items():
+                observations = sum(histogram[:-1])
+                histograms[name + _format_labels(labels)] = {
+                    "count": observations,
+                    "sum": histogram[-1],
+                    "mean": histogram[-1] / observations if observations else 0.0
+                }
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted({**self._counters, **self._gauges}.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, observations in zip(BUCKETS, histogram):
+                    cumulative += observations
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+                cumulative += histogram[len(BUCKETS)]
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+class NoopMetrics:
+    """Same interface as Metrics, records nothing."""
+
+    _span = nullcontext()
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        pass
+
+    def span(self, name: str, **labels):
+        return self._span
+
+    def snapshot(self) -> Dict:
+        return {"counters": {}, "gauges": {}, "histograms": {}}
+
+    def render_prometheus(self) -> str:
+        return ""
+
+    def reset(self) -> None:
+        pass
+
+
+if METRICS_MODE == "off":
+    metrics = NoopMetrics()
+else:
+    metrics = Metrics(METRICS_JSON_LOG if METRICS_MODE == "json" else None)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the app's own output
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    # Serves the metrics from a background thread, returns None when port is 0
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from sqlite_util import ThreadLocalConnection
+
+# Load environment variables
+load_dotenv()
+
+# Backend for cached LLM responses: "sqlite", "directory" or "none". Both on-disk backends work offline and can be
+# shared by several worker processes on the same machine.
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "sqlite").lower()
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./.cache/llm_cache")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds, 0 means no expiry
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))  # per namespace, least recently used go first
+# The embeddings namespace has its own limits: a backfill embeds tens of thousands of stories, and those entries must
+# outlive it to be reused. An embedding never changes for the same text and model, so the default TTL is long.
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+# "deterministic" (default) bypasses the cache for sampled (temperature > 0 or unset) requests so story segments keep
+# producing fresh text, "always" caches every request. Callers whose output may be replayed, like story summaries,
+# pass cache_policy="always" to the llm_client helpers.
+LLM_CACHE_POLICY = os.getenv("LLM_CACHE_POLICY", "deterministic").lower()
+
+
+def _normalize(value):
+    # Whitespace-insensitive so the same prompt with different indentation (the f-string prompts) shares an entry
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def cache_key(**request) -> str:
+    # Content hash of the normalized request. Every parameter that changes the response must be passed in.
+    payload = json.dumps(_normalize(request), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def should_cache(temperature: Optional[float], policy: Optional[str] = None) -> bool:
+    if (policy or LLM_CACHE_POLICY) == "deterministic":
+        # The API default temperature is 1, so an unset temperature counts as sampled
+        return temperature is not None and temperature == 0
+    return True
+
+
+class NullCache:
+    def get(self, key: str) -> Optional[Dict]:
+        return None
+
+    def set(self, key: str, value: Dict) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class SQLiteCache:
+    """Key/value cache in one SQLite file, one table per namespace, with TTL and least-recently-used eviction.
+
+    Expired entries are never returned; they and the entries beyond max_entries are deleted by evict(), which set()
+    runs every evict_every writes rather than on each one.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 evict_every: int = 50):
+        self.path = path
+        self.table = f"cache_{namespace}"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self._connection = ThreadLocalConnection(path, synchronous="NORMAL")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                         f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed_at)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_created ON {self.table} (created_at)")
+
+
+    def get(self, key: str) -> Optional[Dict]:
+        conn = self._connection()
+        row = conn.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        with conn:
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Dict) -> None:
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                         (key, json.dumps(value), now, now))
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        conn = self._connection()
+        with conn:
+            if self.ttl:
+                conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl,))
+            conn.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                         f"ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+
+class DirectoryCache:
+    """Key/value cache as one JSON file per entry under a namespace directory.
+
+    A file's mtime is its creation time, which the TTL counts from as in SQLiteCache, and its atime is the last access,
+    which orders the least-recently-used eviction. Both are read with one stat, so evict() doesn't open any file.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.directory = os.path.join(path, namespace)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            created_at = os.stat(path).st_mtime
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        now = time.time()
+        if self.ttl and now - created_at > self.ttl:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, (now, created_at))  # last access, keeping the creation time
+        except FileNotFoundError:
+            pass
+        return entry["value"]
+
+    def set(self, key: str, value: Dict) -> None:
+        # Write to a temp file and rename, so readers in other processes never see a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "value": value}, f)
+        os.replace(tmp_path, self._path(key))
+        with self._writes_lock:
+            self._writes += 1
+            # Listing the directory is the expensive part, so only check the size bound every so often
+            due = self._writes % 50 == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_mtime, entry.path))
+        now = time.time()
+        entries.sort(reverse=True)
+        for position, (_, created_at, path) in enumerate(entries):
+            if position >= self.max_entries or (self.ttl and now - created_at > self.ttl):
+                self._remove(path)
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.directory):
+            self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace: str):
+    # One cache object per namespace per process, backed by the configured LLM_CACHE_BACKEND
+    if namespace == "embeddings":
+        limits = {"ttl": EMBEDDING_CACHE_TTL, "max_entries": EMBEDDING_CACHE_MAX_ENTRIES}
+    else:
+        limits = {"ttl": LLM_CACHE_TTL, "max_entries": LLM_CACHE_MAX_ENTRIES}
+    with _caches_lock:
+        if namespace not in _caches:
+            if LLM_CACHE_BACKEND == "sqlite":
+                _caches[namespace] = SQLiteCache(f"{LLM_CACHE_PATH}.sqlite3", namespace, **limits)
+            elif LLM_CACHE_BACKEND == "directory":
+                _caches[namespace] = DirectoryCache(LLM_CACHE_PATH, namespace, **limits)
+            else:
+                _caches[namespace] = NullCache()
+        return _caches[namespace]
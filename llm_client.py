@@ -0,0 +1,217 @@
+import asyncio
+import os
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from instrumentation import metrics
+from llm_cache import NullCache, cache_key, get_cache, should_cache
+from utils import count_tokens
+
+# Load environment variables
+load_dotenv()
+
+# Connection pool sizing, shared by every story session in the process
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+REQUEST_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+
+def _pool_limits():
+    import httpx
+    return httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+
+
+# openai and httpx are imported on first use, importing the openai package alone takes most of a second
+
+@lru_cache(maxsize=None)
+def get_client() -> "OpenAI":
+    # One blocking client per process so keep-alive connections are reused across modules and requests
+    import httpx
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(limits=_pool_limits(), timeout=REQUEST_TIMEOUT),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_async_client() -> "AsyncOpenAI":
+    # One async client per process. Its pool is bound to the event loop that first uses it, which is the
+    # Gradio server loop for the app.
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.AsyncClient(limits=_pool_limits(), timeout=REQUEST_TIMEOUT),
+    )
+
+
+def _completion_request(model: str, messages: List[Dict[str, str]], max_tokens: int,
+                        temperature: Optional[float]) -> Dict:
+    request = {"model": model, "messages": messages, "max_tokens": max_tokens}
+    if temperature is not None:
+        request["temperature"] = temperature
+    return request
+
+
+def _cache_lookup(request: Dict, use_cache: bool,
+                  cache_policy: Optional[str] = None) -> Tuple[Optional[str], Optional[Dict]]:
+    # Returns (key, cached entry). key is None when the request bypasses the cache. cache_policy overrides
+    # LLM_CACHE_POLICY for this request.
+    if not use_cache or not should_cache(request.get("temperature"), cache_policy):
+        return None, None
+    key = cache_key(**request)
+    cached = get_cache("chat").get(key)
+    metrics.count("llm_cache_hits_total" if cached is not None else "llm_cache_misses_total", kind="chat")
+    return key, cached
+
+
+def _cache_store(key: Optional[str], content: str, total_tokens: int) -> None:
+    if key is not None:
+        get_cache("chat").set(key, {"content": content, "total_tokens": total_tokens})
+
+
+def _estimate_tokens(messages: List[Dict[str, str]], content: str) -> int:
+    # Used when a stream doesn't report usage (e.g. a proxy stripped it)
+    return sum(count_tokens(message["content"]) for message in messages) + count_tokens(content)
+
+
+def _record_usage(model: str, mode: str, content: str, total_tokens: int) -> None:
+    metrics.count("llm_tokens_total", total_tokens, model=model, mode=mode)
+    metrics.count("llm_response_bytes_total", len(content.encode("utf-8")), model=model, mode=mode)
+
+
+# The helpers below return (content, total_tokens). A cache hit costs nothing, so it reports 0 tokens.
+
+def chat_completion(model: str, messages: List[Dict[str, str]], max_tokens: int,
+                    temperature: Optional[float] = None, use_cache: bool = True,
+                    cache_policy: Optional[str] = None) -> Tuple[str, int]:
+    request = _completion_request(model, messages, max_tokens, temperature)
+    key, cached = _cache_lookup(request, use_cache, cache_policy)
+    if cached is not None:
+        return cached["content"], 0
+
+    with metrics.span("llm_call", model=model, mode="chat"):
+        response = get_client().chat.completions.create(**request)
+    content = response.choices[0].message.content
+    _record_usage(model, "chat", content, response.usage.total_tokens)
+    _cache_store(key, content, response.usage.total_tokens)
+    return content, response.usage.total_tokens
+
+
+def stream_chat_completion(model: str, messages: List[Dict[str, str]], max_tokens: int,
+                           temperature: Optional[float] = None, use_cache: bool = True,
+                           cache_policy: Optional[str] = None):
+    # Yields the text received so far as tokens arrive and returns (content, total_tokens), use with `yield from`
+    request = _completion_request(model, messages, max_tokens, temperature)
+    key, cached = _cache_lookup(request, use_cache, cache_policy)
+    if cached is not None:
+        yield cached["content"]
+        return cached["content"], 0
+
+    # llm_call covers the whole stream including the time the caller spends between chunks, llm_first_token is how
+    # long the reader waits before text starts appearing
+    with metrics.span("llm_call", model=model, mode="stream"):
+        start = time.perf_counter()
+        stream = get_client().chat.completions.create(**request, stream=True,
+                                                      stream_options={"include_usage": True})
+
+        content = ""
+        total_tokens = 0
+        for chunk in stream:
+            if chunk.usage is not None:  # Last chunk carries the usage and no choices
+                total_tokens = chunk.usage.total_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not content:
+                    metrics.observe("llm_first_token_seconds", time.perf_counter() - start, model=model)
+                content += delta
+                yield content
+
+    total_tokens = total_tokens or _estimate_tokens(messages, content)
+    _record_usage(model, "stream", content, total_tokens)
+    _cache_store(key, content, total_tokens)
+    return content, total_tokens
+
+
+# The cache is SQLite (or files) and a write can wait up to 30s on another process's lock, so the async helpers
+# reach it from a thread to keep the event loop free
+
+async def achat_completion(model: str, messages: List[Dict[str, str]], max_tokens: int,
+                           temperature: Optional[float] = None, use_cache: bool = True,
+                           cache_policy: Optional[str] = None) -> Tuple[str, int]:
+    request = _completion_request(model, messages, max_tokens, temperature)
+    key, cached = await asyncio.to_thread(_cache_lookup, request, use_cache, cache_policy)
+    if cached is not None:
+        return cached["content"], 0
+
+    with metrics.span("llm_call", model=model, mode="chat"):
+        response = await get_async_client().chat.completions.create(**request)
+    content = response.choices[0].message.content
+    _record_usage(model, "chat", content, response.usage.total_tokens)
+    await asyncio.to_thread(_cache_store, key, content, response.usage.total_tokens)
+    return content, response.usage.total_tokens
+
+
+async def astream_chat_completion(model: str, messages: List[Dict[str, str]], max_tokens: int,
+                                  temperature: Optional[float] = None, use_cache: bool = True,
+                                  cache_policy: Optional[str] = None):
+    # Async generators cannot return a value: yields the text so far as str, then (content, total_tokens) last
+    request = _completion_request(model, messages, max_tokens, temperature)
+    key, cached = await asyncio.to_thread(_cache_lookup, request, use_cache, cache_policy)
+    if cached is not None:
+        yield cached["content"]
+        yield cached["content"], 0
+        return
+
+    with metrics.span("llm_call", model=model, mode="stream"):
+        start = time.perf_counter()
+        stream = await get_async_client().chat.completions.create(**request, stream=True,
+                                                                  stream_options={"include_usage": True})
+
+        content = ""
+        total_tokens = 0
+        async for chunk in stream:
+            if chunk.usage is not None:
+                total_tokens = chunk.usage.total_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not content:
+                    metrics.observe("llm_first_token_seconds", time.perf_counter() - start, model=model)
+                content += delta
+                yield content
+
+    total_tokens = total_tokens or _estimate_tokens(messages, content)
+    _record_usage(model, "stream", content, total_tokens)
+    await asyncio.to_thread(_cache_store, key, content, total_tokens)
+    yield content, total_tokens
+
+
+def create_embeddings(texts: List[str], model: str, batch_size: int = 256, use_cache: bool = True) -> List[List[float]]:
+    # Embeds texts in order. Cached vectors (content-addressed by model + text) are reused and the rest are sent in
+    # requests of up to batch_size inputs.
+    cache = get_cache("embeddings") if use_cache else NullCache()
+    keys = [cache_key(model=model, input=text) for text in texts]
+    embeddings = [cache.get(key) for key in keys]
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    metrics.count("embed_cache_hits_total", len(texts) - len(missing))
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        with metrics.span("embed", model=model):
+            response = get_client().embeddings.create(input=[texts[i] for i in batch], model=model)
+        metrics.count("embed_inputs_total", len(batch), model=model)
+        metrics.count("llm_tokens_total", response.usage.total_tokens, model=model, mode="embed")
+        for item in response.data:  # Results carry the position of their input within the request
+            i = batch[item.index]
+            embeddings[i] = item.embedding
+            cache.set(keys[i], item.embedding)
+
+    return embeddings
@@ -0,0 +1,82 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+import audio_generator as ag
+from instrumentation import debug, metrics
+
+# TTS is heavy on the CPU/GPU, so a process runs few narrations at once and queues a bounded number behind them.
+# When the queue is full new segments are not narrated rather than delaying the story.
+NARRATION_WORKERS = int(os.getenv("NARRATION_WORKERS", "1"))
+NARRATION_QUEUE_SIZE = int(os.getenv("NARRATION_QUEUE_SIZE", "8"))
+
+
+class NarrationPipeline:
+    """Process-wide worker pool that synthesizes story segments in the background."""
+
+    def __init__(self, workers: int = NARRATION_WORKERS, queue_size: int = NARRATION_QUEUE_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="narration")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, text: str, speaker: str, user_id: Optional[str] = None) -> Optional[Future]:
+        if not self.slots.acquire(blocking=False):
+            metrics.count("narration_skipped_total")
+            debug("Narration queue full, skipping narration for this segment")
+            return None
+        # Each segment gets its own file in the audio store, so concurrent stories never share an output path
+        future = self.executor.submit(ag.generate_audio, text, speaker, user_id)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> NarrationPipeline:
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = NarrationPipeline()
+        return _pipeline
+
+
+class NarrationSession:
+    """Narration for one story: queues each segment as the story engine yields it and cancels what's left when the
+    story ends."""
+
+    def __init__(self, speaker: str, user_id: Optional[str] = None, pipeline: Optional[NarrationPipeline] = None):
+        self.speaker = speaker
+        self.user_id = user_id
+        self.pipeline = pipeline or get_pipeline()
+        self.futures: List[Future] = []  # segments still queued or being synthesized
+        self.latest: Optional[Future] = None  # the newest segment's audio, None if it wasn't narrated
+        self.closed = False
+
+    def narrate(self, text: str) -> Optional[Future]:
+        if self.closed or not text.strip():
+            return None
+        future = self.pipeline.submit(text, self.speaker, self.user_id)
+        # Finished segments have nothing left to cancel, so the list doesn't grow with the story
+        self.futures = [pending for pending in self.futures if not pending.done()]
+        if future is not None:
+            self.futures.append(future)
+        self.latest = future
+        return future
+
+    def is_latest(self, future: Future) -> bool:
+        # A newer segment has been queued (the child already chose), so this one's audio is stale
+        return future is not None and self.latest is future
+
+    def finish(self) -> None:
+        # The story is complete: no more segments, but the last one still plays
+        self.closed = True
+
+    def close(self) -> None:
+        # Queued segments are dropped, one already being synthesized finishes but nobody plays it
+        self.closed = True
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.latest = None
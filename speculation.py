@@ -0,0 +1,148 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from instrumentation import error, metrics
+
+# Worker threads for speculative branches of the sync story engine, each offered choice uses one
+SPECULATION_WORKERS = int(os.getenv("SPECULATION_WORKERS", "12"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculation")
+        return _executor
+
+
+class SpeculationStats:
+    """Process-wide counters to weigh the latency win of speculation against its token cost."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = 0  # Chosen branch was pre-generated
+            self.misses = 0  # Custom choice (or failed branch), fell back to the normal path
+            self.used_tokens = 0
+            self.wasted_tokens = 0  # Tokens of branches that finished but were not chosen
+            self.cancelled = 0  # Branches stopped before they finished, their cost is unknown
+
+    def record(self, **increments: int) -> None:
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "used_tokens": self.used_tokens,
+                "wasted_tokens": self.wasted_tokens,
+                "cancelled": self.cancelled
+            }
+
+
+speculation_stats = SpeculationStats()
+
+
+def get_speculation_stats() -> Dict[str, float]:
+    return speculation_stats.snapshot()
+
+
+def _part_tokens(part: Tuple) -> int:
+    # Story parts are generate_story_part tuples, the token count is the second item
+    return part[1]
+
+
+class SpeculativeBranches:
+    """Story parts for each offered choice, generated in background threads while the child is choosing."""
+
+    def __init__(self, branches: Dict[str, Callable[[], Tuple]]):
+        executor = _get_executor()
+        self.futures = {choice: executor.submit(call) for choice, call in branches.items()}
+
+    def take(self, choice: str) -> Optional[Tuple]:
+        # Returns the pre-generated part for the choice (waiting for it if still running), or None on a miss.
+        # Either way every other branch is discarded.
+        future = self.futures.pop(choice, None)
+        self.discard()
+        if future is None:
+            speculation_stats.record(misses=1)
+            return None
+        if future.cancel():
+            # Still queued behind other stories' branches in the shared pool. Waiting for it would be slower than
+            # the normal path, which also streams its text, so it counts as a miss.
+            speculation_stats.record(misses=1, cancelled=1)
+            return None
+        try:
+            part = future.result()
+        except Exception as e:
+            metrics.count("speculation_errors_total")
+            error(f"Speculative branch failed, falling back to the normal path: {str(e)}")
+            speculation_stats.record(misses=1)
+            return None
+        speculation_stats.record(hits=1, used_tokens=_part_tokens(part))
+        return part
+
+    def discard(self) -> None:
+        for future in self.futures.values():
+            if future.cancel():
+                speculation_stats.record(cancelled=1)
+            else:
+                # Already running, the blocking call can't be interrupted so count its tokens once it's done
+                future.add_done_callback(_count_wasted)
+        self.futures = {}
+
+
+def _count_wasted(future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        speculation_stats.record(wasted_tokens=_part_tokens(future.result()))
+
+
+class AsyncSpeculativeBranches:
+    """Async twin of SpeculativeBranches, branches are tasks on the running event loop and can be cancelled mid-request."""
+
+    def __init__(self, branches: Dict[str, Callable[[], Awaitable[Tuple]]]):
+        self.tasks = {choice: asyncio.create_task(make_part()) for choice, make_part in branches.items()}
+
+    async def take(self, choice: str) -> Optional[Tuple]:
+        task = self.tasks.pop(choice, None)
+        self.discard()
+        if task is None:
+            speculation_stats.record(misses=1)
+            return None
+        try:
+            part = await task
+        except Exception as e:
+            metrics.count("speculation_errors_total")
+            error(f"Speculative branch failed, falling back to the normal path: {str(e)}")
+            speculation_stats.record(misses=1)
+            return None
+        speculation_stats.record(hits=1, used_tokens=_part_tokens(part))
+        return part
+
+    def discard(self) -> None:
+        for task in self.tasks.values():
+            if task.done():
+                if not task.cancelled() and task.exception() is None:
+                    speculation_stats.record(wasted_tokens=_part_tokens(task.result()))
+            else:
+                task.cancel()
+                speculation_stats.record(cancelled=1)
+        self.tasks = {}
@@ -0,0 +1,28 @@
+import sqlite3
+import threading
+from typing import Optional
+
+
+class ThreadLocalConnection:
+    """Callable returning this thread's connection to one SQLite file, opened on first use.
+
+    sqlite3 connections can't be shared between threads, so each thread gets its own. WAL lets readers in other threads
+    and worker processes carry on while one writes. synchronous="NORMAL" skips the fsync on every commit, which is safe
+    with WAL short of a power loss, for stores whose latest writes can be recomputed (caches, sessions).
+    """
+
+    def __init__(self, path: str, timeout: float = 30, synchronous: Optional[str] = None):
+        self.path = path
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self._local = threading.local()
+
+    def __call__(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.synchronous:
+                conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlite_util import ThreadLocalConnection
+
+
+class StoryCatalog:
+    """Per-user index of saved stories (user_id -> story ids, titles and metadata) in SQLite.
+
+    Listing a user's titles or fetching one story is an indexed lookup here, so it never goes through vector search.
+    The vector index stays the store for embeddings; both are written together when a story is saved.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = ThreadLocalConnection(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS stories (user_id TEXT NOT NULL, story_id TEXT NOT NULL, "
+                         "story_name TEXT NOT NULL, metadata TEXT NOT NULL, updated_at REAL NOT NULL, "
+                         "PRIMARY KEY (user_id, story_id))")
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_by_user ON stories (user_id, updated_at DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_by_title ON stories (user_id, story_name)")
+            # Users whose stories were already copied over from the vector index, see vector_db_operation
+            conn.execute("CREATE TABLE IF NOT EXISTS backfilled_users (user_id TEXT PRIMARY KEY)")
+
+
+    def add_stories(self, stories: List[Tuple[str, str, Dict]]) -> None:
+        # stories are (user_id, story_id, metadata) as upserted to the vector index
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO stories (user_id, story_id, story_name, metadata, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(user_id, story_id, metadata.get("story_name", "Untitled Story"), json.dumps(metadata), now)
+                 for user_id, story_id, metadata in stories]
+            )
+
+    def list_stories(self, user_id: str, limit: Optional[int] = None, offset: int = 0) -> List[Tuple[str, Dict]]:
+        # (story_name, metadata) pairs, most recently saved first
+        rows = self._connection().execute(
+            "SELECT story_name, metadata FROM stories WHERE user_id = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (user_id, -1 if limit is None else limit, offset)
+        ).fetchall()
+        return [(story_name, json.loads(metadata)) for story_name, metadata in rows]
+
+    def get_story(self, user_id: str, story_name: str) -> Optional[Dict]:
+        # Titles aren't unique ("Story about <name>"), the most recent one wins like the first item of list_stories
+        row = self._connection().execute(
+            "SELECT metadata FROM stories WHERE user_id = ? AND story_name = ? ORDER BY updated_at DESC LIMIT 1",
+            (user_id, story_name)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count_stories(self, user_id: str) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM stories WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def is_backfilled(self, user_id: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM backfilled_users WHERE user_id = ?",
+                                          (user_id,)).fetchone() is not None
+
+    def mark_backfilled(self, user_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO backfilled_users (user_id) VALUES (?)", (user_id,))
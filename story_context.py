@@ -0,0 +1,124 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+from instrumentation import debug, metrics
+from utils import count_tokens
+
+# Prompt token budget for each story segment request. gpt-4 has an 8k window and each segment needs room for
+# its 300 completion tokens, so the default leaves plenty of headroom.
+STORY_CONTEXT_TOKEN_BUDGET = int(os.getenv("STORY_CONTEXT_TOKEN_BUDGET", "3000"))
+# Number of most recent turns that are always sent verbatim, older ones get folded into the running summary
+STORY_CONTEXT_RECENT_TURNS = int(os.getenv("STORY_CONTEXT_RECENT_TURNS", "2"))
+
+
+def default_summarizer(text: str) -> str:
+    # Imported here so the context can be used (and tested) without the vector DB module
+    from vector_db_operation import summarize_story
+    return summarize_story(text)
+
+
+class StoryContext:
+    """Conversation sent to the LLM for a story, kept under a prompt token budget.
+
+    The system prompt and the opening user prompt are always kept. Each turn is the assistant's segment plus the
+    user's choice. Once the prompt goes over budget, the oldest turns are replaced by a running summary. Per-turn
+    system instructions are never stored here, the caller appends the current one to the list from messages().
+    """
+
+    def __init__(self, system_prompt: str, initial_prompt: str, token_budget: int = STORY_CONTEXT_TOKEN_BUDGET,
+                 recent_turns: int = STORY_CONTEXT_RECENT_TURNS, summarizer: Optional[Callable[[str], str]] = None):
+        self.system_prompt = system_prompt
+        self.initial_prompt = initial_prompt
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summarizer = summarizer or default_summarizer
+        self.summary = ""
+        self.turns = []  # [{"assistant": ..., "user": ..., "tokens": ...}]
+        self._fixed_tokens = count_tokens(system_prompt) + count_tokens(initial_prompt)
+        self._summary_tokens = 0
+
+    def add_turn(self, assistant: str, user: str) -> None:
+        # Token counts are cached per turn so the budget check doesn't re-encode the whole history every turn
+        self.turns.append({
+            "assistant": assistant,
+            "user": user,
+            "tokens": count_tokens(assistant) + count_tokens(user)
+        })
+
+    def fork(self) -> "StoryContext":
+        # Independent copy for a speculative branch, adding turns to it leaves this context untouched
+        forked = StoryContext.__new__(StoryContext)
+        forked.__dict__.update(self.__dict__)
+        forked.turns = list(self.turns)
+        return forked
+
+    def to_dict(self) -> Dict:
+        # Plain JSON-serializable form for session stores. The summarizer is code, not state, so it isn't included.
+        return {
+            "system_prompt": self.system_prompt,
+            "initial_prompt": self.initial_prompt,
+            "token_budget": self.token_budget,
+            "recent_turns": self.recent_turns,
+            "summary": self.summary,
+            "turns": self.turns,
+            "fixed_tokens": self._fixed_tokens,
+            "summary_tokens": self._summary_tokens
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict, summarizer: Optional[Callable[[str], str]] = None) -> "StoryContext":
+        # Stored token counts are reused, so restoring a session doesn't re-encode the whole history
+        context = cls.__new__(cls)
+        context.system_prompt = data["system_prompt"]
+        context.initial_prompt = data["initial_prompt"]
+        context.token_budget = data["token_budget"]
+        context.recent_turns = data["recent_turns"]
+        context.summarizer = summarizer or default_summarizer
+        context.summary = data["summary"]
+        context.turns = [dict(turn) for turn in data["turns"]]
+        context._fixed_tokens = data["fixed_tokens"]
+        context._summary_tokens = data["summary_tokens"]
+        return context
+
+    def token_count(self) -> int:
+        return self._fixed_tokens + self._summary_tokens + sum(turn["tokens"] for turn in self.turns)
+
+    def needs_compaction(self) -> bool:
+        return self.token_count() > self.token_budget and len(self.turns) > self.recent_turns
+
+    def compact(self) -> bool:
+        # Folds everything but the most recent turns into the running summary. Returns False (and keeps the turns)
+        # if the summarizer fails, an over-budget prompt is better than losing the story.
+        if not self.needs_compaction():
+            return False
+
+        cut = len(self.turns) - self.recent_turns
+        old_turns = self.turns[:cut]
+        text = "\n\n".join(
+            ([self.summary] if self.summary else []) +
+            [f"{turn['assistant']}\n{turn['user'].strip()}" for turn in old_turns]
+        )
+        with metrics.span("context_summarize"):
+            summary = self.summarizer(text)
+        if not summary:
+            debug("Story context summarization failed, keeping full history")
+            return False
+
+        debug(f"Folded {len(old_turns)} turns into the story summary")
+        self.summary = summary
+        self._summary_tokens = count_tokens(summary)
+        self.turns = self.turns[cut:]
+        return True
+
+    def messages(self) -> List[Dict[str, str]]:
+        # Fresh list each call, so the per-turn instruction appended by generate_story_part never accumulates
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.initial_prompt}
+        ]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the story so far: {self.summary}"})
+        for turn in self.turns:
+            messages.append({"role": "assistant", "content": turn["assistant"]})
+            messages.append({"role": "user", "content": turn["user"]})
+        return messages
@@ -1,23 +1,20 @@
-import os
+import asyncio
+from functools import partial
 from dotenv import load_dotenv
 from utils import estimate_reading_time, clean_text
 from typing import Dict, List, Optional, Tuple
 from vector_db_operation import retrieve_and_continue_story
-# from LINH import image_description @ LINH
+from story_context import StoryContext
+from speculation import AsyncSpeculativeBranches, SpeculativeBranches
+from image_registry import get_image_registry
+from instrumentation import debug, metrics
 
-# OpenAI and ChatGPT
-from openai import OpenAI
+# OpenAI and ChatGPT, shared pooled clients
+from llm_client import achat_completion, astream_chat_completion, chat_completion, stream_chat_completion
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# Placeholder for now to test everything else working
-image_description = ["eye-monster", "magic-cupcake", "purple-unicorn"] # this is a placeholder for now until Linh import above works for image_description list.
-
-
 
 def create_system_prompt(user_data: Dict[str, any]) -> str:
     continuation_reminder = "This is a continuation of a previous story. Refer to elements from the previous adventures when appropriate." if user_data.get(
@@ -49,12 +46,8 @@ def create_initial_prompt(user_data: Dict[str, any], is_continued: bool) -> str:
         return f"Start a brief bedtime story about {user_data['name']} in {user_data['place']}. Opening segment should end with a need for the main character to make a choice."
 
 
-def generate_story_part(messages: List[Dict[str, str]], name: str, unused_images: List[str], max_tokens: int = 300,
-                        is_final: bool = False, is_continued: bool = False) -> Tuple[
-    str, int, List[str], List[str], List[str]]: # Receives the unused_images list
-
-    print(f"** DEBUG: generate_story_part called with is_final={is_final}")
-
+def add_segment_instruction(messages: List[Dict[str, str]], name: str, unused_images: List[str],
+                            is_final: bool = False, is_continued: bool = False) -> None:
     # function here incorproates up to two images from unused_images. These image descriptions are included in the prompt sent to the AI
     image_prompt = f"In this segment, incorporate these elements: {', '.join(unused_images[:2])}" if unused_images else "Continue the story without introducing new visual elements."
 
@@ -74,24 +67,77 @@ def generate_story_part(messages: List[Dict[str, str]], name: str, unused_images
             "content": f"{image_prompt} Begin a new story about {name}. The opening segment should introduce the character and setting, and set up an initial situation or challenge. The story segment should be engaging but brief, no longer than 6 sentences at the most. It is crucial that you end this segment with a clear decision point for the user, presenting exactly three distinct options. Format the options as follows:\n\nWhat will {name} do next?\n1. [First option]\n2. [Second option]\n3. [Third option]"
         })
 
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=messages,
-        max_tokens=max_tokens,
-    )
-
-    content = response.choices[0].message.content
 
+def finish_story_part(content: str, total_tokens: int, unused_images: List[str], is_final: bool = False) -> Tuple[
+    str, int, List[str], List[str], List[str]]:
     # Add a clear segment separator so I can choose to show latest segment only, instead of using "\n\n" as a strip cut which doesnt always work
-    content = f"<segment>{content.strip()}</segment>"
+    with metrics.span("parse"):
+        content = f"<segment>{content.strip()}</segment>"
 
-    choices = extract_choices(content) if not is_final else []
+        choices = extract_choices(content) if not is_final else []
 
     # If choices are not generated and it's not the final segment, add a note in the debug log
     if not is_final and not choices:
-        print("** DEBUG: No choices generated in this segment. This may need manual review.")
+        metrics.count("story_parts_without_choices_total")
+        debug("No choices generated in this segment. This may need manual review.")
+
+    return content, total_tokens, unused_images[2:], unused_images[:2], choices # After generating content, returns the used image descriptions
+
+
+def generate_story_part(messages: List[Dict[str, str]], name: str, unused_images: List[str], max_tokens: int = 300,
+                        is_final: bool = False, is_continued: bool = False) -> Tuple[
+    str, int, List[str], List[str], List[str]]: # Receives the unused_images list
+
+    debug(f"generate_story_part called with is_final={is_final}")
+
+    add_segment_instruction(messages, name, unused_images, is_final=is_final, is_continued=is_continued)
+
+    content, total_tokens = chat_completion(model="gpt-4", messages=messages, max_tokens=max_tokens)
+
+    return finish_story_part(content, total_tokens, unused_images, is_final=is_final)
 
-    return content, response.usage.total_tokens, unused_images[2:], unused_images[:2], choices # After generating content, returns the used image descriptions
+
+def stream_story_part(messages: List[Dict[str, str]], name: str, unused_images: List[str], max_tokens: int = 300,
+                      is_final: bool = False, is_continued: bool = False):
+    # Streaming twin of generate_story_part: yields the text received so far as tokens arrive, and returns the same
+    # tuple as generate_story_part (via StopIteration.value) once the segment is complete.
+    debug(f"stream_story_part called with is_final={is_final}")
+
+    add_segment_instruction(messages, name, unused_images, is_final=is_final, is_continued=is_continued)
+
+    content, total_tokens = yield from stream_chat_completion(model="gpt-4", messages=messages, max_tokens=max_tokens)
+
+    return finish_story_part(content, total_tokens, unused_images, is_final=is_final)
+
+
+async def agenerate_story_part(messages: List[Dict[str, str]], name: str, unused_images: List[str], max_tokens: int = 300,
+                               is_final: bool = False, is_continued: bool = False) -> Tuple[
+    str, int, List[str], List[str], List[str]]:
+    # Async twin of generate_story_part, awaits the shared pooled client instead of blocking a worker thread
+    debug(f"agenerate_story_part called with is_final={is_final}")
+
+    add_segment_instruction(messages, name, unused_images, is_final=is_final, is_continued=is_continued)
+
+    content, total_tokens = await achat_completion(model="gpt-4", messages=messages, max_tokens=max_tokens)
+
+    return finish_story_part(content, total_tokens, unused_images, is_final=is_final)
+
+
+async def astream_story_part(messages: List[Dict[str, str]], name: str, unused_images: List[str], max_tokens: int = 300,
+                             is_final: bool = False, is_continued: bool = False):
+    # Async twin of stream_story_part. Async generators cannot return a value, so the text received so far is yielded
+    # as str and the finished generate_story_part tuple is yielded as the last item.
+    debug(f"astream_story_part called with is_final={is_final}")
+
+    add_segment_instruction(messages, name, unused_images, is_final=is_final, is_continued=is_continued)
+
+    async for item in astream_chat_completion(model="gpt-4", messages=messages, max_tokens=max_tokens):
+        if isinstance(item, tuple):
+            content, total_tokens = item
+        else:
+            yield item
+
+    yield finish_story_part(content, total_tokens, unused_images, is_final=is_final)
 
 
 def extract_choices(content: str) -> List[str]:
@@ -103,17 +149,56 @@ def extract_choices(content: str) -> List[str]:
     return []
 
 
-def generate_bedtime_story(user_id: str, image_descriptions: List[str], is_continued: bool = False, story_choice: str = None, **kwargs):
-    print(
-        f"Debug: generate_bedtime_story called with user_id={user_id}, is_continued={is_continued}, story_choice={story_choice}, kwargs={kwargs}")
+def partial_story_state(full_story: str, all_segments: List[Dict], partial_text: str) -> Dict:
+    # Story state yielded while a segment is still streaming in. Consumers should call next() (not send()) on these.
+    return {
+        "story": full_story,
+        "segments": all_segments,
+        "complete": False,
+        "choices": [],
+        "partial": True,
+        "partial_text": partial_text.split("\n\nWhat will")[0].strip()
+    }
+
+
+def run_story_part(full_story: str, all_segments: List[Dict], stream: bool, **part_kwargs):
+    # Runs one story part in blocking or streaming mode. In streaming mode a partial story state is yielded each time
+    # new text comes in; either way the generate_story_part tuple is the return value, so callers use `yield from`.
+    if not stream:
+        return generate_story_part(**part_kwargs)
+
+    part_stream = stream_story_part(**part_kwargs)
+    while True:
+        try:
+            partial_text = next(part_stream)
+        except StopIteration as done:
+            return done.value
+        yield partial_story_state(full_story, all_segments, partial_text)
+
+
+async def arun_story_part(full_story: str, all_segments: List[Dict], stream: bool, **part_kwargs):
+    # Async twin of run_story_part: yields partial story states (dict) while streaming, then the generate_story_part
+    # tuple as the last item.
+    if not stream:
+        yield await agenerate_story_part(**part_kwargs)
+        return
+
+    async for item in astream_story_part(**part_kwargs):
+        if isinstance(item, tuple):
+            yield item
+        else:
+            yield partial_story_state(full_story, all_segments, item)
+
+
+def resolve_user_data(user_id: str, is_continued: bool, story_choice: Optional[str], kwargs: Dict) -> Tuple[Dict, bool]:
     if is_continued:
         user_data = retrieve_and_continue_story(user_id, story_choice)
         if user_data is None:
-            print("Debug: No existing story found, starting a new one")
+            debug("No existing story found, starting a new one")
             is_continued = False
             user_data = kwargs
         else:
-            print(f"Debug: Retrieved existing story data: {user_data}")
+            debug(f"Retrieved existing story about {user_data.get('name')} in {user_data.get('place')}")
             # Update the retrieved data with new inputs
             user_data.update(kwargs)
     else:
@@ -123,115 +208,319 @@ def generate_bedtime_story(user_id: str, image_descriptions: List[str], is_conti
     required_fields = ['name', 'place', 'tone', 'moral', 'length', 'age']
     for field in required_fields:
         if field not in user_data:
-            print(f"Debug: Missing required field: {field}")
+            debug(f"Missing required field: {field}")
             raise ValueError(f"Missing required field: {field}")
 
+    return user_data, is_continued
+
+
+def new_story_state(user_data: Dict, image_descriptions: List[str], is_continued: bool, **context_kwargs) -> Dict:
+    # Everything the story loop carries from one turn to the next. Shared by the sync and async engines.
+    # context_kwargs (token_budget, recent_turns, summarizer) are passed on to StoryContext.
     system_prompt = create_system_prompt(user_data)
     initial_prompt = create_initial_prompt(user_data, is_continued)
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": initial_prompt}
-    ]
-
-    full_story = ""
-    all_segments = []
-    current_length = 0
-    total_tokens = 0
-    unused_images = image_descriptions.copy() # So image_descriptions, a list of image names to be used, gets put in as an argument whe generate_bedtime_story called. This then creates a copy of image_description
-    max_tokens = max(800, int(user_data['length'] * 300))
-    story_concluding = False
-
-    while current_length < user_data['length']:
-        print(f"Debug: Generating story part. Current length: {current_length}, Target length: {user_data['length']}")
-        try:
-            story_part, part_tokens, unused_images, segment_images, choices = generate_story_part(
-                messages=messages,
-                name=user_data['name'],
-                unused_images=unused_images,
-                max_tokens=300,
-                is_final=story_concluding,
-                is_continued=is_continued
-            )
-            print(f"Debug: Story part generated. Tokens: {part_tokens}")
-        except Exception as e:
-            print(f"Debug: Error in generate_story_part: {str(e)}")
-            raise
-
-        part_length = estimate_reading_time(story_part)
-        current_length += part_length
-        total_tokens += part_tokens
-
-        print(f"Debug: Updated length: {current_length}, Total tokens: {total_tokens}")
-
-        # Extract content between segment tags
-        narrative = story_part.split("<segment>")[-1].split("</segment>")[0]
-
-        # ...and extract content before choices
-        narrative = story_part.split("\n\nWhat will")[0].strip()  # Separate narrative from choices
-
-        full_story += narrative.strip() + "\n\n"
-
-        #  Functions receives data from generate_story_part and updates the segment information
-        all_segments.append({
-            "text": narrative.strip(),
-            "images": segment_images,
-            "choices": choices
-        })
+    return {
+        "user_data": user_data,
+        "context": StoryContext(system_prompt, initial_prompt, **context_kwargs),
+        "full_story": "",
+        "segments": [],
+        "current_length": 0,
+        "total_tokens": 0,
+        "unused_images": image_descriptions.copy(), # So image_descriptions, a list of image names to be used, gets put in as an argument whe generate_bedtime_story called. This then creates a copy of image_description
+        "is_concluding": False,
+        "is_continued": is_continued,
+        "last_part": None,
+        "finishing": False,  # the next part is the final one (set when a choice ends the story early)
+        "complete": False
+    }
+
+
+def story_in_progress(state: Dict) -> bool:
+    return state["current_length"] < state["user_data"]['length']
+
+
+def story_part_kwargs(state: Dict, is_final: Optional[bool] = None) -> Dict:
+    # Arguments for the next generate_story_part call (or one of its streaming/async twins)
+    debug(f"Generating story part. Current length: {state['current_length']}, Target length: {state['user_data']['length']}")
+    return {
+        "messages": state["context"].messages(),
+        "name": state["user_data"]['name'],
+        "unused_images": state["unused_images"],
+        "max_tokens": 300,
+        "is_final": state["is_concluding"] if is_final is None else is_final,
+        "is_continued": True if is_final else state["is_continued"]
+    }
+
+
+def record_story_part(state: Dict, part: Tuple[str, int, List[str], List[str], List[str]]) -> Dict:
+    # Folds a finished story part into the state and returns the story data to yield to the caller
+    story_part, part_tokens, unused_images, segment_images, choices = part
+    debug(f"Story part generated. Tokens: {part_tokens}")
+    metrics.count("story_parts_total", final="false")
+    metrics.count("story_tokens_total", part_tokens)
+
+    state["unused_images"] = unused_images
+    state["last_part"] = story_part
+    state["current_length"] += estimate_reading_time(story_part)
+    state["total_tokens"] += part_tokens
+
+    debug(f"Updated length: {state['current_length']}, Total tokens: {state['total_tokens']}")
+
+    # Extract content between segment tags
+    narrative = story_part.split("<segment>")[-1].split("</segment>")[0]
+
+    # ...and extract content before choices
+    narrative = story_part.split("\n\nWhat will")[0].strip()  # Separate narrative from choices
+
+    state["full_story"] += narrative.strip() + "\n\n"
+
+    #  Functions receives data from generate_story_part and updates the segment information
+    state["segments"].append({
+        "text": narrative.strip(),
+        "images": segment_images,
+        "choices": choices
+    })
 
-        if current_length >= user_data['length'] * 0.8 and not story_concluding:
-            print("Debug: Story is nearing conclusion")
-            story_concluding = True
+    if state["current_length"] >= state["user_data"]['length'] * 0.8 and not state["is_concluding"]:
+        debug("Story is nearing conclusion")
+        state["is_concluding"] = True
 
-        print("Debug: Yielding current story state")
-        user_choice = yield {
-            "story": full_story,
-            "segments": all_segments,
-            "complete": False,
-            "choices": choices
-        }
+    debug("Yielding current story state")
+    return {
+        "story": state["full_story"],
+        "segments": state["segments"],
+        "complete": False,
+        "choices": choices,
+        "total_tokens": state["total_tokens"]
+    }
 
-        if story_concluding:
-            break
 
-        print(f"Debug: Received user choice: {user_choice}")
+def choice_prompt(user_data: Dict, user_choice: str) -> str:
+    return f"\n{user_data['name']} decides to {user_choice}. Continue the story based on this action, and end with a new set of choices or decision points."
 
-        if user_choice.lower() == 'exit story':
-            print("Debug: User requested to exit story")
-            break
 
-        try:
-            next_prompt = f"\n{user_data['name']} decides to {user_choice}. Continue the story based on this action, and end with a new set of choices or decision points."
-            messages.append({"role": "assistant", "content": story_part})
-            messages.append({"role": "user", "content": next_prompt})
-            print("Debug: Added user choice to messages")
-        except Exception as e:
-            print(f"Debug: Error processing user choice: {str(e)}")
-            raise
-
-        is_continued = True  # Set to True after the first iteration
-
-    print("Debug: Generating final segment")
-    final_segment, final_tokens, _, final_images, _ = generate_story_part(
-        messages=messages,
-        name=user_data['name'],
-        unused_images=unused_images,
-        max_tokens=300,
-        is_final=True,
-        is_continued=True
-    )
-
-    full_story += final_segment.strip() + "\n\n"
-    all_segments.append({
+def branch_part_kwargs(state: Dict, user_choice: str) -> Dict:
+    # Arguments for the part that would follow user_choice, built on a fork so the real state is left alone
+    context = state["context"].fork()
+    context.add_turn(state["last_part"], choice_prompt(state["user_data"], user_choice))
+    return {
+        "messages": context.messages(),
+        "name": state["user_data"]['name'],
+        "unused_images": list(state["unused_images"]),
+        "max_tokens": 300,
+        "is_final": False,
+        "is_continued": True
+    }
+
+
+def should_speculate(state: Dict, story_data: Dict) -> bool:
+    # Once the story is concluding the next part is the ending whatever the choice, so there is nothing to branch on
+    return not state["is_concluding"] and bool(story_data["choices"])
+
+
+def apply_user_choice(state: Dict, user_choice: str) -> bool:
+    # Adds the user's choice to the conversation. Returns False when the story should move on to its final segment.
+    if state["is_concluding"]:
+        return False
+
+    debug(f"Received user choice: {user_choice}")
+
+    if user_choice.lower() == 'exit story':
+        debug("User requested to exit story")
+        return False
+
+    state["context"].add_turn(state["last_part"], choice_prompt(state["user_data"], user_choice))
+    debug("Added user choice to messages")
+
+    state["is_continued"] = True  # Set to True after the first iteration
+    return True
+
+
+def record_final_part(state: Dict, part: Tuple[str, int, List[str], List[str], List[str]]) -> Dict:
+    final_segment, final_tokens, _, final_images, _ = part
+    state["total_tokens"] += final_tokens
+    state["complete"] = True
+    metrics.count("story_parts_total", final="true")
+    metrics.count("story_tokens_total", final_tokens)
+    metrics.count("stories_completed_total")
+
+    state["full_story"] += final_segment.strip() + "\n\n"
+    state["segments"].append({
         "text": final_segment.strip(),
         "images": final_images,
         "choices": []
     })
 
-    print("Debug: Story complete")
-    yield {
-        "story": full_story,
-        "segments": all_segments,
+    debug(f"Story complete. Total tokens: {state['total_tokens']}")
+    return {
+        "story": state["full_story"],
+        "segments": state["segments"],
         "complete": True,
-        "choices": []
-    } # Updated story state is yielded to Gradio Interface
\ No newline at end of file
+        "choices": [],
+        "total_tokens": state["total_tokens"]
+    } # Updated story state is yielded to Gradio Interface
+
+
+def aspeculate_branches(state: Dict, story_data: Dict) -> Optional[AsyncSpeculativeBranches]:
+    # Starts generating the part after each offered choice on the running event loop, None if there is nothing to
+    # branch on
+    if not should_speculate(state, story_data):
+        return None
+    return AsyncSpeculativeBranches({
+        choice: partial(agenerate_story_part, **branch_part_kwargs(state, choice))
+        for choice in story_data["choices"]
+    })
+
+
+def story_state_to_dict(state: Dict) -> Dict:
+    # JSON-serializable snapshot of a story state, for the session stores in story_session
+    data = dict(state)
+    data["context"] = state["context"].to_dict()
+    return data
+
+
+def story_state_from_dict(data: Dict, summarizer=None) -> Dict:
+    state = dict(data)
+    state["context"] = StoryContext.from_dict(data["context"], summarizer)
+    return state
+
+
+async def astart_story_session(user_id: str, image_descriptions: Optional[List[str]] = None,
+                               is_continued: bool = False, story_choice: str = None,
+                               context_options: Optional[Dict] = None, **kwargs) -> Dict:
+    # Initial state of a story driven by astory_session_step, nothing is generated yet
+    user_data, is_continued = await asyncio.to_thread(resolve_user_data, user_id, is_continued, story_choice, kwargs)
+    if image_descriptions is None:
+        image_descriptions = await asyncio.to_thread(lambda: get_image_registry().descriptions(user_id))
+    return new_story_state(user_data, image_descriptions, is_continued, **(context_options or {}))
+
+
+async def astory_session_step(state: Dict, user_choice: Optional[str] = None, stream: bool = False,
+                              part: Optional[Tuple] = None):
+    # One turn of the story as an explicit state machine over a plain state dict, so the state can be stored between
+    # turns and the next turn can run in any worker. The first call passes no choice; later ones pass the user's
+    # choice, which is applied first. Yields partial story states while streaming, then the story data (last item).
+    # part is a pre-generated next part for user_choice (speculation), ignored when the next part is the final one.
+    if user_choice is not None:
+        if apply_user_choice(state, user_choice):
+            if state["context"].needs_compaction():
+                await asyncio.to_thread(state["context"].compact)
+        else:
+            state["finishing"] = True
+
+    is_final = state["finishing"] or not story_in_progress(state)
+    if is_final:
+        debug("Generating final segment")
+        part = None
+    if part is None:
+        async for item in arun_story_part(state["full_story"], state["segments"], stream,
+                                          **story_part_kwargs(state, is_final=True if is_final else None)):
+            if isinstance(item, tuple):
+                part = item
+            else:
+                yield item
+
+    yield record_final_part(state, part) if is_final else record_story_part(state, part)
+
+
+def generate_bedtime_story(user_id: str, image_descriptions: Optional[List[str]] = None, is_continued: bool = False,
+                           story_choice: str = None, stream: bool = False, context_options: Optional[Dict] = None,
+                           speculative: bool = False, **kwargs):
+    # With stream=True, partial states (partial=True) are yielded while each segment streams in, followed by the usual
+    # complete segment state which is the only one that accepts a user choice via send().
+    # context_options (token_budget, recent_turns, summarizer) bound the prompt, see StoryContext.
+    # With speculative=True the part following each offered choice is generated in the background while the child
+    # is choosing, so picking a button returns straight away. Custom choices fall back to the normal path.
+    # Without image_descriptions the user's images from the image registry are used.
+    debug(f"generate_bedtime_story called with user_id={user_id}, is_continued={is_continued}, story_choice={story_choice}")
+    user_data, is_continued = resolve_user_data(user_id, is_continued, story_choice, kwargs)
+    if image_descriptions is None:
+        image_descriptions = get_image_registry().descriptions(user_id)
+    state = new_story_state(user_data, image_descriptions, is_continued, **(context_options or {}))
+
+    branches = None
+    user_choice = None
+    try:
+        while story_in_progress(state):
+            part = branches.take(user_choice) if branches is not None else None
+            if part is None:
+                try:
+                    part = yield from run_story_part(state["full_story"], state["segments"], stream,
+                                                     **story_part_kwargs(state))
+                except Exception as e:
+                    debug(f"Error in generate_story_part: {str(e)}")
+                    raise
+
+            story_data = record_story_part(state, part)
+            branches = None
+            if speculative and should_speculate(state, story_data):
+                branches = SpeculativeBranches({
+                    choice: partial(generate_story_part, **branch_part_kwargs(state, choice))
+                    for choice in story_data["choices"]
+                })
+
+            user_choice = yield story_data
+
+            if not apply_user_choice(state, user_choice):
+                break
+            state["context"].compact()
+    finally:
+        if branches is not None:
+            branches.discard()
+
+    debug("Generating final segment")
+    part = yield from run_story_part(state["full_story"], state["segments"], stream,
+                                     **story_part_kwargs(state, is_final=True))
+    yield record_final_part(state, part)
+
+
+async def agenerate_bedtime_story(user_id: str, image_descriptions: Optional[List[str]] = None,
+                                  is_continued: bool = False, story_choice: str = None, stream: bool = False,
+                                  context_options: Optional[Dict] = None, speculative: bool = False, **kwargs):
+    # Async twin of generate_bedtime_story, drive it with asend()/anext(). The vector DB lookup for continued stories
+    # still uses the blocking Pinecone client, so it runs in a thread to keep the event loop free.
+    debug(f"agenerate_bedtime_story called with user_id={user_id}, is_continued={is_continued}, story_choice={story_choice}")
+    user_data, is_continued = await asyncio.to_thread(resolve_user_data, user_id, is_continued, story_choice, kwargs)
+    if image_descriptions is None:
+        image_descriptions = await asyncio.to_thread(lambda: get_image_registry().descriptions(user_id))
+    state = new_story_state(user_data, image_descriptions, is_continued, **(context_options or {}))
+
+    branches = None
+    user_choice = None
+    try:
+        while story_in_progress(state):
+            part = await branches.take(user_choice) if branches is not None else None
+            if part is None:
+                try:
+                    async for item in arun_story_part(state["full_story"], state["segments"], stream,
+                                                      **story_part_kwargs(state)):
+                        if isinstance(item, tuple):
+                            part = item
+                        else:
+                            yield item
+                except Exception as e:
+                    debug(f"Error in agenerate_story_part: {str(e)}")
+                    raise
+
+            story_data = record_story_part(state, part)
+            branches = aspeculate_branches(state, story_data) if speculative else None
+
+            user_choice = yield story_data
+
+            if not apply_user_choice(state, user_choice):
+                break
+            if state["context"].needs_compaction():
+                await asyncio.to_thread(state["context"].compact)
+    finally:
+        if branches is not None:
+            branches.discard()
+
+    debug("Generating final segment")
+    async for item in arun_story_part(state["full_story"], state["segments"], stream,
+                                      **story_part_kwargs(state, is_final=True)):
+        if isinstance(item, tuple):
+            part = item
+        else:
+            yield item
+    yield record_final_part(state, part)
@@ -0,0 +1,271 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from instrumentation import error, info, metrics
+from speculation import AsyncSpeculativeBranches
+from sqlite_util import ThreadLocalConnection
+
+# Where story sessions live between turns: "sqlite" (default, shared by every worker process on the machine and kept
+# across restarts) or "memory" (this process only).
+STORY_SESSION_BACKEND = os.getenv("STORY_SESSION_BACKEND", "sqlite").lower()
+STORY_SESSION_PATH = os.getenv("STORY_SESSION_PATH", "./.cache/story_sessions.sqlite3")
+# Abandoned stories are dropped after STORY_SESSION_TTL idle seconds (0 means never), and beyond STORY_SESSION_MAX live
+# sessions the least recently active ones go first
+STORY_SESSION_TTL = float(os.getenv("STORY_SESSION_TTL", "3600"))
+STORY_SESSION_MAX = int(os.getenv("STORY_SESSION_MAX", "10000"))
+STORY_SESSION_REAP_INTERVAL = float(os.getenv("STORY_SESSION_REAP_INTERVAL", "60"))  # seconds between reaper runs
+
+
+class InMemorySessionStore:
+    """Sessions as JSON strings in a dict, least recently active first. Stored as strings so a loaded session never
+    aliases the stored one, the same as with the SQLite store.
+
+    Every put bumps the session's version. put() with the version a session was loaded at only writes if nobody else
+    wrote in between, so two turns on the same session (a double click) can't silently overwrite each other.
+    """
+
+    def __init__(self, ttl: float = STORY_SESSION_TTL, max_sessions: int = STORY_SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session_id -> (data, last activity, version)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        return self.get_versioned(session_id)[0]
+
+    def get_versioned(self, session_id: str) -> Tuple[Optional[Dict], Optional[int]]:
+        # (session, version), (None, None) when there is no such session
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None, None
+            self._sessions[session_id] = (entry[0], time.time(), entry[2])
+            self._sessions.move_to_end(session_id)
+        return json.loads(entry[0]), entry[2]
+
+    def put(self, session_id: str, session: Dict, version: Optional[int] = None) -> bool:
+        # Without a version the session is written unconditionally, with one only if it is still at that version.
+        # Returns False when the write was refused.
+        data = json.dumps(session)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if version is not None and (entry is None or entry[2] != version):
+                return False
+            self._sessions[session_id] = (data, time.time(), entry[2] + 1 if entry is not None else 0)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return True
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def reap(self) -> int:
+        # Drops sessions idle for longer than ttl, returns how many
+        if not self.ttl:
+            return 0
+        cutoff = time.time() - self.ttl
+        reaped = 0
+        with self._lock:
+            while self._sessions and next(iter(self._sessions.values()))[1] < cutoff:
+                self._sessions.popitem(last=False)
+                reaped += 1
+        return reaped
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"live": len(self._sessions),
+                    "bytes": sum(sys.getsizeof(data) for data, _, _ in self._sessions.values())}
+
+
+class SQLiteSessionStore:
+    """Sessions as JSON rows in one SQLite file. updated_at is the last activity (read or write) of a session, version
+    is bumped on every write (see InMemorySessionStore.put). max_sessions is enforced every trim_every writes and on
+    each reap, so it can be briefly exceeded in between."""
+
+    def __init__(self, path: str, ttl: float = STORY_SESSION_TTL, max_sessions: int = STORY_SESSION_MAX,
+                 trim_every: int = 50):
+        self.path = path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.trim_every = trim_every
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self._connection = ThreadLocalConnection(path, synchronous="NORMAL")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                         "updated_at REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "version" not in columns:  # created before sessions were versioned
+                conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        return self.get_versioned(session_id)[0]
+
+    def get_versioned(self, session_id: str) -> Tuple[Optional[Dict], Optional[int]]:
+        conn = self._connection()
+        row = conn.execute("SELECT data, version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None, None
+        with conn:
+            conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (time.time(), session_id))
+        return json.loads(row[0]), row[1]
+
+    def put(self, session_id: str, session: Dict, version: Optional[int] = None) -> bool:
+        conn = self._connection()
+        with conn:
+            if version is None:
+                conn.execute("INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?) "
+                             "ON CONFLICT (session_id) DO UPDATE SET data = excluded.data, "
+                             "updated_at = excluded.updated_at, version = version + 1",
+                             (session_id, json.dumps(session), time.time()))
+            elif conn.execute("UPDATE sessions SET data = ?, updated_at = ?, version = version + 1 "
+                              "WHERE session_id = ? AND version = ?",
+                              (json.dumps(session), time.time(), session_id, version)).rowcount == 0:
+                return False
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.trim_every == 0
+        if due:
+            self.trim()
+        return True
+
+    def trim(self) -> int:
+        # Deletes the least recently active sessions beyond max_sessions. It walks the updated_at index, so put() only
+        # runs it every trim_every writes and the reaper on each run.
+        conn = self._connection()
+        with conn:
+            return conn.execute("DELETE FROM sessions WHERE session_id IN (SELECT session_id FROM sessions "
+                                "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)", (self.max_sessions,)).rowcount
+
+    def delete(self, session_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def reap(self) -> int:
+        reaped = self.trim()
+        if not self.ttl:
+            return reaped
+        conn = self._connection()
+        with conn:
+            return reaped + conn.execute("DELETE FROM sessions WHERE updated_at < ?",
+                                         (time.time() - self.ttl,)).rowcount
+
+    def stats(self) -> Dict:
+        live, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions").fetchone()
+        return {"live": live, "bytes": size}
+
+
+def create_session_store(backend: str, path: Optional[str] = None):
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(path or STORY_SESSION_PATH)
+    raise ValueError(f"Unknown story session backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def get_session_store():
+    return create_session_store(STORY_SESSION_BACKEND, STORY_SESSION_PATH)
+
+
+class SessionSpeculations:
+    """Speculative branches per session, in this process only.
+
+    Branches are running tasks, so they can't be stored with the session. If the next click is handled by another
+    worker it simply finds none and generates the part itself; the branches left here are discarded by reap() once
+    the session has been idle for ttl seconds, or when more than max_sessions sessions have some.
+    All methods must be called from the event loop the branches run on.
+    """
+
+    def __init__(self, ttl: float = STORY_SESSION_TTL, max_sessions: int = STORY_SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._branches = OrderedDict()  # session_id -> (branches, started at)
+
+    def start(self, session_id: str, branches: Optional[AsyncSpeculativeBranches]) -> None:
+        self.discard(session_id)
+        if branches is not None:
+            self._branches[session_id] = (branches, time.time())
+        while len(self._branches) > self.max_sessions:
+            self._branches.popitem(last=False)[1][0].discard()
+
+    async def take(self, session_id: str, choice: str):
+        entry = self._branches.pop(session_id, None)
+        return await entry[0].take(choice) if entry is not None else None
+
+    def discard(self, session_id: str) -> None:
+        entry = self._branches.pop(session_id, None)
+        if entry is not None:
+            entry[0].discard()
+
+    def reap(self) -> int:
+        if not self.ttl:
+            return 0
+        cutoff = time.time() - self.ttl
+        reaped = 0
+        while self._branches and next(iter(self._branches.values()))[1] < cutoff:
+            self._branches.popitem(last=False)[1][0].discard()
+            reaped += 1
+        return reaped
+
+    def __len__(self) -> int:
+        return len(self._branches)
+
+
+speculations = SessionSpeculations()
+
+
+class SessionReaper:
+    """Background thread that reaps idle sessions from a store every interval seconds, logs the live session count and
+    the bytes they hold, and publishes both as the story_sessions_live and story_sessions_bytes gauges."""
+
+    def __init__(self, store, interval: float = STORY_SESSION_REAP_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="story-session-reaper", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                metrics.count("story_session_reaper_errors_total")
+                error(f"Story session reaper failed: {str(e)}")
+
+    def run_once(self) -> Dict:
+        reaped = self.store.reap()
+        stats = self.store.stats()
+        stats["reaped"] = reaped
+        stats["speculating"] = len(speculations)
+        metrics.gauge("story_sessions_live", stats["live"])
+        metrics.gauge("story_sessions_bytes", stats["bytes"])
+        metrics.gauge("story_sessions_speculating", stats["speculating"])
+        metrics.count("story_sessions_reaped_total", reaped)
+        info(f"Story sessions: live={stats['live']} bytes={stats['bytes']} reaped={reaped} "
+             f"speculating={stats['speculating']}")
+        return stats
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
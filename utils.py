@@ -1,10 +1,14 @@
 import os
 import tiktoken
-import nltk
+from functools import lru_cache
 from typing import List
 
-# Initialize tokenizer
-tokenizer = tiktoken.get_encoding("cl100k_base")
+
+# Tokenizer is loaded on first use, tiktoken downloads the encoding the first time it runs on a machine
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    return tiktoken.get_encoding("cl100k_base")
+
 
 # Environment variables
 WORDS_PER_MINUTE = int(os.getenv("WORDS_PER_MINUTE", "100"))
@@ -25,13 +29,14 @@ def get_image_descriptions() -> List[str]:
     return ["flying-purple-dragon", "enchanted-forest", "magical-unicorn"]
 """
 def count_tokens(text: str) -> int:
-    return len(tokenizer.encode(text))
+    return len(get_tokenizer().encode(text))
 
 def estimate_reading_time(text: str) -> float:
     word_count = len(text.split())
     return word_count / WORDS_PER_MINUTE
 
-def clean_text(text: str) -> str:
+def clean_sentences(text: str) -> List[str]:
+    import nltk  # imported on first use, it adds about a third of a second to every process start
     text = text.strip()  # Remove leading/trailing whitespace
     text = ' '.join(text.split())  # Remove extra spaces between words
     sentences = nltk.sent_tokenize(text)
@@ -44,4 +49,7 @@ def clean_text(text: str) -> str:
         if not sentence.endswith(('.', '!', '?')):
             sentence += '.'
         cleaned_sentences.append(sentence)
-    return ' '.join(cleaned_sentences)
\ No newline at end of file
+    return cleaned_sentences
+
+def clean_text(text: str) -> str:
+    return ' '.join(clean_sentences(text))
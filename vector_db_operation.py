@@ -1,59 +1,77 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import Dict, Optional, List, Tuple
 
-from openai import OpenAI
-from pinecone import Pinecone, ServerlessSpec
+from instrumentation import debug, error, info, metrics
+from llm_client import chat_completion, create_embeddings
+from story_catalog import StoryCatalog
+from vector_store import create_vector_store
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Bulk save settings, see summarize_and_upsert_stories
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "8"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))  # the embeddings API accepts up to 2048 inputs
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
 
-# Initialize Pinecone client
-pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+# Vector store backend: "pinecone" (default) or "local" for an in-process store with no network
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone").lower()
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "./.cache/vector_store")
 
-# Check if the index exists, and if not, create it
 index_name = 'bedtime-stories'
-if index_name not in pc.list_indexes().names():
-    pc.create_index(
-        name=index_name,
-        dimension=1536,
-        metric='euclidean',
-        spec=ServerlessSpec(
-            cloud='aws',
-            region='us-east-1'  # free tier region
-        )
-    )
 
-# renaming it to just 'index'
-index = pc.Index(index_name)
+# Per-user catalog of saved stories, answers title listing and story lookup without touching the vector index
+STORY_CATALOG_PATH = os.getenv("STORY_CATALOG_PATH", "./.cache/story_catalog.sqlite3")
+LEGACY_BACKFILL_TOP_K = int(os.getenv("LEGACY_BACKFILL_TOP_K", "1000"))
+
+
+# Handles are created on first use and shared by the whole process, so importing this module (and everything that
+# imports it) costs no network I/O and works offline.
+
+@lru_cache(maxsize=None)
+def get_index():
+    return create_vector_store(VECTOR_STORE_BACKEND, index_name, dimension=1536, metric='euclidean',
+                               path=VECTOR_STORE_PATH)
 
-def retrieve_existing_story_titles(user_id: str) -> List[Tuple[str, Dict]]:
-    results = index.query(
-        vector=[0] * 1536,  # Mock vector just for filtering by metadata
-        filter={"user_id": user_id},
-        top_k=10,
-        include_metadata=True
-    )
+
+@lru_cache(maxsize=None)
+def get_catalog() -> StoryCatalog:
+    return StoryCatalog(STORY_CATALOG_PATH)
+
+
+def backfill_catalog_from_index(user_id: str) -> None:
+    # One-off copy of a user's stories saved before the catalog existed. This is the only place that still uses a
+    # metadata-filtered vector query; it runs at most once per user.
+    with metrics.span("vector_query", backend=VECTOR_STORE_BACKEND):
+        results = get_index().query(
+            vector=[0] * 1536,  # Mock vector just for filtering by metadata
+            filter={"user_id": user_id},
+            top_k=LEGACY_BACKFILL_TOP_K,
+            include_metadata=True
+        )
 
     if results and results["matches"]:
-        stories = []
-        for match in results["matches"]:
-            metadata = match["metadata"]
-            story_name = metadata.get("story_name", "Untitled Story")
-            stories.append((story_name, metadata))
-        return stories
-    else:
-        return []
+        get_catalog().add_stories([(user_id, match["id"], match["metadata"]) for match in results["matches"]])
+    get_catalog().mark_backfilled(user_id)
+
+
+def retrieve_existing_story_titles(user_id: str, limit: Optional[int] = None, offset: int = 0) -> List[Tuple[str, Dict]]:
+    # (story_name, metadata) for the user's stories, newest first, from the catalog. limit/offset paginate.
+    if not get_catalog().is_backfilled(user_id):
+        backfill_catalog_from_index(user_id)
+    with metrics.span("catalog_query"):
+        return get_catalog().list_stories(user_id, limit=limit, offset=offset)
 
 def retrieve_and_continue_story(user_id: str, story_choice: str) -> Optional[Dict[str, any]]:
-    stories = retrieve_existing_story_titles(user_id)
-    selected_story = next((story for story in stories if story[0] == story_choice), None)
+    if not get_catalog().is_backfilled(user_id):
+        backfill_catalog_from_index(user_id)
+    metadata = get_catalog().get_story(user_id, story_choice)
 
-    if selected_story:
-        _, metadata = selected_story
+    if metadata:
         return {
             "name": metadata.get('name'),
             "place": metadata.get('place'),
@@ -66,33 +84,29 @@ def retrieve_and_continue_story(user_id: str, story_choice: str) -> Optional[Dic
             "is_continued": True
         }
     else:
-        print(f"No story found with title: {story_choice}")
+        debug(f"No story found with title: {story_choice}")
         return None
 
 def summarize_story(full_story: str, max_tokens: int = 150) -> str:
     try:
-        response = client.chat.completions.create(
+        # Cached whatever LLM_CACHE_POLICY says, so re-saving an unchanged story doesn't pay for the summary again
+        summary, _ = chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that summarizes bedtime stories."},
                 {"role": "user", "content": f"Please summarize the following bedtime story in about {max_tokens} tokens:\n\n{full_story}"}
             ],
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            cache_policy="always"
         )
-        return response.choices[0].message.content.strip()
+        return summary.strip()
     except Exception as e:
-        print(f"Error in summarizing story: {e}")
+        metrics.count("story_summary_errors_total")
+        error(f"Error in summarizing story: {e}")
         return ""
 
-def summarize_and_upsert_story(user_id: str, name: str, full_story: str, place: str, story_name: str = None, image_descriptions: List[str] = None):
-    summary = summarize_story(full_story)
-
-    embedding_response = client.embeddings.create(
-        input=summary,
-        model="text-embedding-ada-002"
-    )
-    embedding = embedding_response.data[0].embedding
-
+def story_vector(user_id: str, name: str, place: str, summary: str, embedding: List[float], story_name: str = None,
+                 image_descriptions: List[str] = None) -> Dict:
     metadata = {
         "user_id": user_id,
         "name": name,
@@ -102,10 +116,61 @@ def summarize_and_upsert_story(user_id: str, name: str, full_story: str, place:
         "image_descriptions": image_descriptions or []
     }
 
-    index.upsert(vectors=[{
+    return {
         "id": story_name or name,
         "values": embedding,
         "metadata": metadata
-    }])
+    }
+
+
+def summarize_and_upsert_stories(stories: List[Dict], max_workers: int = SUMMARY_WORKERS,
+                                 embed_batch_size: int = EMBED_BATCH_SIZE,
+                                 upsert_batch_size: int = UPSERT_BATCH_SIZE) -> List[str]:
+    # Bulk version of summarize_and_upsert_story for saves, migrations and backfills. Each story is a dict with the
+    # summarize_and_upsert_story arguments (user_id, name, full_story, place, optional story_name and
+    # image_descriptions). Summaries run concurrently, embeddings go out in batches and vectors are upserted in
+    # chunks. Returns the ids that were upserted; stories whose summary failed are skipped.
+    if not stories:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(executor.map(lambda story: summarize_story(story["full_story"]), stories))
+
+    summarized = [(story, summary) for story, summary in zip(stories, summaries) if summary]
+    if len(summarized) < len(stories):
+        info(f"Skipping {len(stories) - len(summarized)} stories that could not be summarized.")
+    if not summarized:
+        return []
+
+    embeddings = create_embeddings([summary for _, summary in summarized], model=EMBEDDING_MODEL,
+                                   batch_size=embed_batch_size)
+
+    vectors = [
+        story_vector(story["user_id"], story["name"], story["place"], summary, embedding,
+                     story_name=story.get("story_name"), image_descriptions=story.get("image_descriptions"))
+        for (story, summary), embedding in zip(summarized, embeddings)
+    ]
+    for start in range(0, len(vectors), upsert_batch_size):
+        chunk = vectors[start:start + upsert_batch_size]
+        with metrics.span("vector_upsert", backend=VECTOR_STORE_BACKEND):
+            get_index().upsert(vectors=chunk)
+        metrics.count("vectors_upserted_total", len(chunk))
+        get_catalog().add_stories([(vector["metadata"]["user_id"], vector["id"], vector["metadata"]) for vector in chunk])
+
+    debug(f"{len(vectors)} stories summarized and saved to database.")
+    return [vector["id"] for vector in vectors]
+
+
+def summarize_and_upsert_story(user_id: str, name: str, full_story: str, place: str, story_name: str = None, image_descriptions: List[str] = None):
+    summary = summarize_story(full_story)
+
+    embedding = create_embeddings([summary], model=EMBEDDING_MODEL)[0]
+
+    vector = story_vector(user_id, name, place, summary, embedding, story_name=story_name,
+                          image_descriptions=image_descriptions)
+    with metrics.span("vector_upsert", backend=VECTOR_STORE_BACKEND):
+        get_index().upsert(vectors=[vector])
+    metrics.count("vectors_upserted_total")
+    get_catalog().add_stories([(user_id, vector["id"], vector["metadata"])])
 
-    print(f"Story summarized and saved to database.")
\ No newline at end of file
+    debug("Story summarized and saved to database.")
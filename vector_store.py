@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from sqlite_util import ThreadLocalConnection
+
+# Storage backends for story vectors. Both expose the subset of the Pinecone index API that vector_db_operation
+# uses: upsert(vectors=[{"id", "values", "metadata"}]) and query(vector, filter, top_k, include_metadata), which
+# returns {"matches": [{"id", "score", "metadata"}]} best match first.
+
+
+# How long a successful "index exists" check is trusted before it is repeated
+PINECONE_INDEX_CHECK_TTL = float(os.getenv("PINECONE_INDEX_CHECK_TTL", "3600"))
+
+
+class PineconeStore:
+    # Nothing touches the network until the first upsert/query. The index existence check (and creation if needed)
+    # then runs once and is cached for check_ttl seconds.
+    def __init__(self, index_name: str, dimension: int, metric: str = "euclidean", api_key: Optional[str] = None,
+                 check_ttl: float = PINECONE_INDEX_CHECK_TTL):
+        self.index_name = index_name
+        self.dimension = dimension
+        self.metric = metric
+        self.api_key = api_key
+        self.check_ttl = check_ttl
+        self._pc = None
+        self._index = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at > self.check_ttl:
+                self._ensure_index()
+                self._checked_at = now
+            return self._index
+
+    def _ensure_index(self) -> None:
+        from pinecone import Pinecone, ServerlessSpec
+
+        if self._pc is None:
+            self._pc = Pinecone(api_key=self.api_key)
+
+        # Check if the index exists, and if not, create it
+        if self.index_name not in self._pc.list_indexes().names():
+            self._pc.create_index(
+                name=self.index_name,
+                dimension=self.dimension,
+                metric=self.metric,
+                spec=ServerlessSpec(
+                    cloud='aws',
+                    region='us-east-1'  # free tier region
+                )
+            )
+            self._index = None
+        if self._index is None:
+            self._index = self._pc.Index(self.index_name)
+
+    def upsert(self, vectors: List[Dict]):
+        return self.index.upsert(vectors=vectors)
+
+    def query(self, vector: List[float], filter: Optional[Dict] = None, top_k: int = 10, include_metadata: bool = True):
+        return self.index.query(vector=vector, filter=filter, top_k=top_k, include_metadata=include_metadata)
+
+
+def _filter_value(condition):
+    # Pinecone filters accept {"field": value} and {"field": {"$eq": value}}, only equality is supported here
+    if isinstance(condition, dict):
+        if set(condition) != {"$eq"}:
+            raise ValueError(f"Unsupported filter condition: {condition}")
+        return condition["$eq"]
+    return condition
+
+
+class LocalVectorStore:
+    """In-process vector store for single-node deployments and tests, no network involved.
+
+    Vectors live in a memory-mapped float32 file, one row per story. Ids and metadata live in a SQLite table with an
+    index on user_id, so a user's stories are found without scanning. Search is exact over the candidate rows, or
+    approximate (IVF: k-means lists, only the closest n_probe lists are scanned) once build_ivf() has been called.
+    """
+
+    def __init__(self, path: str, dimension: int, metric: str = "euclidean"):
+        if metric not in ("euclidean", "cosine", "dotproduct"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        self.dimension = dimension
+        self.metric = metric
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self._lock = threading.RLock()
+        self.ivf_centroids = None
+        self.ivf_assignments = None
+        os.makedirs(path, exist_ok=True)
+
+        self.db_path = os.path.join(path, "metadata.sqlite3")
+        self._connection = ThreadLocalConnection(self.db_path)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors "
+                         "(row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, user_id TEXT, metadata TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS vectors_user_id ON vectors (user_id)")
+            self.count = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+        self._open_vectors(max(self.count, 1024))
+
+
+    def _open_vectors(self, capacity: int) -> None:
+        # Grows the backing file to capacity rows (never shrinks it) and maps it
+        row_bytes = self.dimension * 4
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        if size < capacity * row_bytes:
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        self.capacity = size // row_bytes
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dimension))
+
+    def upsert(self, vectors: List[Dict]) -> Dict:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                for vector in vectors:
+                    metadata = vector.get("metadata", {})
+                    existing = conn.execute("SELECT row FROM vectors WHERE id = ?", (vector["id"],)).fetchone()
+                    if existing is not None:
+                        row = existing[0]
+                        conn.execute("UPDATE vectors SET user_id = ?, metadata = ? WHERE row = ?",
+                                     (metadata.get("user_id"), json.dumps(metadata), row))
+                    else:
+                        row = self.count
+                        if row >= self.capacity:
+                            self.vectors.flush()
+                            self._open_vectors(self.capacity * 2)
+                        conn.execute("INSERT INTO vectors (row, id, user_id, metadata) VALUES (?, ?, ?, ?)",
+                                     (row, vector["id"], metadata.get("user_id"), json.dumps(metadata)))
+                        self.count += 1
+                    self.vectors[row] = np.asarray(vector["values"], dtype=np.float32)
+                    if self.ivf_centroids is not None:
+                        self.ivf_assignments = self._assign_ivf(row, self.ivf_assignments)
+            self.vectors.flush()
+        return {"upserted_count": len(vectors)}
+
+    def _candidate_rows(self, filter: Optional[Dict]) -> np.ndarray:
+        # user_id is answered from the index, any other fields are checked against the stored metadata
+        filter = dict(filter or {})
+        if not filter:
+            return np.arange(self.count, dtype=np.int64)
+
+        conn = self._connection()
+        if "user_id" in filter:
+            cursor = conn.execute("SELECT row, metadata FROM vectors WHERE user_id = ?",
+                                  (_filter_value(filter.pop("user_id")),))
+        else:
+            cursor = conn.execute("SELECT row, metadata FROM vectors")
+
+        rows = [
+            row for row, metadata_json in cursor
+            if not filter or all(json.loads(metadata_json).get(key) == _filter_value(condition)
+                                 for key, condition in filter.items())
+        ]
+        return np.asarray(rows, dtype=np.int64)
+
+    def _scores(self, vector: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        # Lower is better for euclidean (squared distance, like Pinecone), higher is better otherwise
+        candidates = self.vectors[rows]
+        if self.metric == "euclidean":
+            return ((candidates - vector) ** 2).sum(axis=1)
+        scores = candidates @ vector
+        if self.metric == "cosine":
+            norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(vector)
+            scores = np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+        return scores
+
+    def query(self, vector: List[float], filter: Optional[Dict] = None, top_k: int = 10, include_metadata: bool = True,
+              approximate: bool = False, n_probe: int = 4) -> Dict:
+        with self._lock:
+            vector = np.asarray(vector, dtype=np.float32)
+            rows = self._candidate_rows(filter)
+            if approximate and self.ivf_centroids is not None and len(rows):
+                nearest_lists = np.argsort(((self.ivf_centroids - vector) ** 2).sum(axis=1))[:n_probe]
+                rows = rows[np.isin(self.ivf_assignments[rows], nearest_lists)]
+            if not len(rows):
+                return {"matches": []}
+
+            scores = self._scores(vector, rows)
+            order = np.argsort(scores if self.metric == "euclidean" else -scores, kind="stable")[:top_k]
+
+            conn = self._connection()
+            records = {
+                row: (vector_id, metadata_json) for row, vector_id, metadata_json in conn.execute(
+                    f"SELECT row, id, metadata FROM vectors WHERE row IN ({','.join('?' * len(order))})",
+                    [int(rows[i]) for i in order])
+            }
+            matches = []
+            for i in order:
+                vector_id, metadata_json = records[int(rows[i])]
+                match = {"id": vector_id, "score": float(scores[i])}
+                if include_metadata:
+                    match["metadata"] = json.loads(metadata_json)
+                matches.append(match)
+            return {"matches": matches}
+
+    def build_ivf(self, n_lists: int = 64, iterations: int = 10, seed: int = 0) -> None:
+        # k-means over the stored vectors. Rows upserted later are assigned to their nearest existing list; rebuild
+        # once the collection has grown a lot.
+        with self._lock:
+            data = np.asarray(self.vectors[:self.count])
+            if not len(data):
+                return
+            n_lists = min(n_lists, len(data))
+            rng = np.random.default_rng(seed)
+            centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+            for _ in range(iterations):
+                assignments = self._nearest_centroid(data, centroids)
+                for list_id in range(n_lists):
+                    members = data[assignments == list_id]
+                    if len(members):
+                        centroids[list_id] = members.mean(axis=0)
+            self.ivf_centroids = centroids
+            self.ivf_assignments = np.full(self.capacity, -1, dtype=np.int64)
+            self.ivf_assignments[:self.count] = self._nearest_centroid(data, centroids)
+
+    @staticmethod
+    def _nearest_centroid(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # ||a - c||^2 = ||a||^2 - 2 a.c + ||c||^2, the ||a||^2 term doesn't change the argmin
+        return np.argmin(-2 * data @ centroids.T + (centroids ** 2).sum(axis=1), axis=1)
+
+    def _assign_ivf(self, row: int, assignments: np.ndarray) -> np.ndarray:
+        if len(assignments) < self.capacity:
+            assignments = np.concatenate([assignments, np.full(self.capacity - len(assignments), -1, dtype=np.int64)])
+        assignments[row] = self._nearest_centroid(self.vectors[row:row + 1], self.ivf_centroids)[0]
+        return assignments
+
+
+def create_vector_store(backend: str, index_name: str, dimension: int, metric: str = "euclidean",
+                        path: Optional[str] = None):
+    if backend == "pinecone":
+        return PineconeStore(index_name, dimension, metric, api_key=os.environ.get("PINECONE_API_KEY"))
+    if backend == "local":
+        return LocalVectorStore(os.path.join(path or "./.cache/vector_store", index_name), dimension, metric)
+    raise ValueError(f"Unknown vector store backend: {backend}")